@@ -1,229 +1,63 @@
-from flask import Flask, request, jsonify
-from search import search
-from filter import Filter
-from storage import DBStorage
-import html
-
-app = Flask(__name__)
-
-styles = """
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=Fira+Code:wght@300..700&display=swap');
-
-    /* Scrollbar styling */
-    ::-webkit-scrollbar {
-    width: 12px;
-    }
-
-    ::-webkit-scrollbar-track {
-    background: #000000;
-    }
-
-    ::-webkit-scrollbar-thumb {
-    background: #ffff00;
-    border: 3px solid #000000;
-    border-radius: 6px;
-    }
-
-    ::-webkit-scrollbar-thumb:hover {
-    background: #000000;
-    }
-
-    body {
-        font-family: 'Fira Code', monospace;
-        max-width: 800px;
-        margin: 0 auto;
-        padding: 20px;
-        background-color: #000000;
-        color: #FFFFFF;
-    }
-
-    .search-container {
-        display: flex;
-        flex-direction: column;
-        align-items: center;
-        justify-content: center;
-        min-height: 60vh;
-        gap: 20px;
-    }
-
-    .search-form {
-        display: flex;
-        gap: 10px;
-        width: 100%;
-        max-width: 600px;
-    }
-
-    input[type="text"] {
-        flex: 1;
-        padding: 12px 20px;
-        font-family: 'Fira Code', monospace;
-        font-size: 16px;
-        border: 2px solid #00FFFF;
-        border-radius: 25px;
-        background: #000000;
-        color: #FFFFFF;
-        outline: none;
-    }
-
-    input[type="text"]:focus {
-        box-shadow: 0 0 15px rgba(0, 255, 255, 0.5);
-    }
-
-    input[type="submit"] {
-        padding: 12px 30px;
-        font-family: 'Fira Code', monospace;
-        font-size: 16px;
-        background-color: #FFFF00;
-        color: #000000;
-        border: none;
-        border-radius: 25px;
-        cursor: pointer;
-        transition: all 0.3s ease;
-    }
-
-    input[type="submit"]:hover {
-        background-color: #00FFFF;
-    }
-
-    .site {
-        font-size: 14px;
-        color: #00FFFF;
-        margin-bottom: 5px;
-    }
-    
-    .snippet {
-        font-size: 14px;
-        color: #CCCCCC;
-        margin-bottom: 30px;
-        line-height: 1.5;
-    }
-    
-    .rel-button {
-        cursor: pointer;
-        color: #FFFF00;
-        margin-left: 10px;
-        transition: color 0.3s ease;
-    }
-
-    .rel-button:hover {
-        color: #00FFFF;
-    }
-
-    a {
-        color: #FFFFFF;
-        text-decoration: none;
-        font-size: 18px;
-        font-weight: 500;
-        display: block;
-        margin: 10px 0;
-    }
-
-    a:hover {
-        color: #FFFF00;
-    }
-
-    .results-container {
-        margin-top: 40px;
-    }
-
-    .loader-container {
-        display: none;
-        justify-content: center;
-        margin: 40px 0;
-        text-align: center;
-    }
-
-    .loader {
-        color: #FFFF00;
-        font-size: 18px;
-        display: block;
-    }
-</style>
-<script>
-document.addEventListener('DOMContentLoaded', function() {
-    const searchForm = document.querySelector('.search-form');
-    const loaderContainer = document.querySelector('.loader-container');
-    const resultsContainer = document.querySelector('.results-container');
-    const loader = document.querySelector('.loader');
-
-    // Create the loading text
-    if (loader) {
-        loader.textContent = 'Fetching search results...';
-    }
-
-    if (searchForm) {
-        searchForm.addEventListener('submit', function() {
-            if (loaderContainer) {
-                loaderContainer.style.display = 'flex';
-            }
-            if (resultsContainer) {
-                resultsContainer.style.display = 'none';
-            }
-        });
-    }
-});
-
-const relevant = function(query, link){
-    fetch("/relevant", {
-        method: 'POST',
-        headers: {
-          'Accept': 'application/json',
-          'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-           "query": query,
-           "link": link
-          })
-        });
-}
-</script>
-"""
-
-search_template = (
-    styles
-    + """
-    <title>ZERO Search</title>
-    <div class="search-container">
-        <form action="/" method="post" class="search-form">
-            <input type="text" name="query" placeholder="Search...">
-            <input type="submit" value="Search">
-        </form>
-    </div>
-    <div class="loader-container">
-        <div class="loader"></div>
-    </div>
-    """
+from flask import Flask, Response, request, jsonify, stream_with_context
+from search import search, search_stream
+from pages import (
+    assets,
+    cached_render,
+    parse_page,
+    rank_and_render,
+    render_result,
+    search_template,
+    server_event,
+    show_search_form,
+    storage,
 )
+from settings import *
+from lazy import lazy_import
+from logs import configure_logging
+import metrics
 
-result_template = """
-<div class="results-container">
-    <p class="site">{rank}: {link} <span class="rel-button" onclick='relevant("{query}", "{link}");'>Relevant</span></p>
-    <a href="{link}">{title}</a>
-    <p class="snippet">{snippet}</p>
-</div>
-"""
+pd = lazy_import("pandas")
+
+configure_logging()
+app = Flask(__name__)
 
 
-def show_search_form():
+def run_search(query, mode=SEARCH_MODE, page=1):
     """
-    Return the search form HTML.
+    Run the search and return a page of results.
     """
-    return search_template
+    with metrics.request_seconds.time(route="search"):
+        rendered, version = cached_render(query, mode, page)
+        if rendered is None:
+            results = search(query, mode, page)
+            if results.attrs.get("local", False):
+                version = None
+            rendered = rank_and_render(query, results, version, page, mode)
+    return search_template + rendered
 
 
-def run_search(query):
+def stream_search(query, mode=SEARCH_MODE, page=1):
     """
-    Run the search and return the results.
+    Run the search and yield the results as Server-Sent Events.
+
+    Each result is sent in a "result" event, rendered with its provisional
+    API rank, as soon as its page has been fetched and scored. Once all
+    pages are in, the filters rank the complete set and a "done" event
+    carries the final rendered results, which replace the provisional ones,
+    and the links to the other pages.
     """
-    results = search(query)
-    fi = Filter(results)
-    filtered = fi.filter()
-    rendered = search_template
-    filtered["snippet"] = filtered["snippet"].apply(lambda x: html.escape(x))
-    for index, row in filtered.iterrows():
-        rendered += result_template.format(**row)
-    return rendered
+    with metrics.request_seconds.time(route="stream"):
+        rendered, version = cached_render(query, mode, page)
+        if rendered is None:
+            rows = []
+            for row in search_stream(query, mode, page):
+                rows.append(row)
+                yield server_event("result", {"html": render_result(row)})
+            results = pd.DataFrame(rows)
+            if mode != "local":
+                results.attrs["more"] = storage.page_more(query, page)
+            rendered = rank_and_render(query, results, version, page, mode)
+        yield server_event("done", {"html": rendered})
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -231,14 +65,42 @@ def search_form():
     """
     Handle the root route for the app. If the request is a POST,
     pull the query out of the form and run the search. If the
-    request is a GET, show the search form.
+    request is a GET with a "query" parameter, run the search too, so
+    the pages of results can be linked; otherwise show the search form.
+    A "page" field picks the page of results, and a "mode" field of
+    "local" answers the query from the local index only.
     """
 
     if request.method == "POST":
         query = request.form["query"]
-        return run_search(query)
+    elif "query" in request.args:
+        query = request.args["query"]
     else:
         return show_search_form()
+    mode = request.values.get("mode", SEARCH_MODE)
+    page = parse_page(request.values.get("page"))
+    return run_search(query, mode, page)
+
+
+@app.route("/stream", methods=["GET"])
+def stream_results():
+    """
+    Stream the results of the "query" parameter as Server-Sent Events.
+
+    The search form uses this endpoint when the browser supports
+    EventSource, so the first results show up after about one page fetch
+    instead of after the whole search. A "page" parameter picks the page
+    of results, and a "mode" parameter of "local" answers the query from
+    the local index only.
+    """
+    query = request.args.get("query", "")
+    mode = request.args.get("mode", SEARCH_MODE)
+    page = parse_page(request.args.get("page"))
+    return Response(
+        stream_with_context(stream_search(query, mode, page)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/relevant", methods=["POST"])
@@ -257,12 +119,40 @@ def mark_relevant():
     }
 
     Returns:
-        JSON response indicating success.
+        JSON response indicating success, or a 400 response if the body
+        is not such a JSON object.
     """
 
-    data = request.get_json()
-    query = data["query"]
-    link = data["link"]
-    storage = DBStorage()
+    data = request.get_json(silent=True)
+    try:
+        query, link = str(data["query"]), str(data["link"])
+    except (KeyError, TypeError):
+        return Response("Bad Request", status=400, mimetype="text/plain")
     storage.update_relevance(query, link, 10)
     return jsonify(success=True)
+
+
+@app.route("/assets/<name>", methods=["GET"])
+def serve_asset(name):
+    """
+    Serve the stylesheet and script of the pages.
+
+    The pages link them with a version parameter that changes with their
+    content, so browsers may cache them for ASSET_MAX_AGE seconds.
+    """
+    if name not in assets:
+        return Response("Not Found", status=404, mimetype="text/plain")
+    body, content_type = assets[name]
+    return Response(
+        body,
+        content_type=content_type,
+        headers={"Cache-Control": f"public, max-age={ASSET_MAX_AGE}, immutable"},
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def show_metrics():
+    """
+    Serve the metrics of this process in the Prometheus text format.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,200 @@
+"""
+ASGI entry point of the search engine.
+
+The routes are the same as in app.py, but searches run on the async
+pipeline in search.py, so a single process can serve many concurrent
+searches while they wait on the network. Run it with any ASGI server,
+for example:
+
+    uvicorn asgi:app --port 5001
+"""
+
+import asyncio
+import json
+from urllib.parse import parse_qs
+from pages import (
+    assets,
+    cached_render,
+    parse_page,
+    rank_and_render,
+    render_result,
+    search_template,
+    server_event,
+    show_search_form,
+    storage,
+)
+from search import async_search, async_search_stream, get_client
+from settings import *
+from lazy import lazy_import
+from logs import configure_logging
+import metrics
+
+pd = lazy_import("pandas")
+
+configure_logging()
+
+
+async def read_body(receive):
+    """
+    Read the complete body of an HTTP request.
+    """
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def respond(
+    send, status, body, content_type="text/html; charset=utf-8", headers=()
+):
+    """
+    Send a complete HTTP response, with any extra (name, value) headers.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    headers = [("content-type", content_type)] + list(headers)
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (name.encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def run_search(query, mode=SEARCH_MODE, page=1):
+    """
+    Run the search and return a page of results.
+    """
+    with metrics.request_seconds.time(route="search"):
+        rendered, version = await asyncio.to_thread(cached_render, query, mode, page)
+        if rendered is None:
+            results = await async_search(query, mode, page)
+            if results.attrs.get("local", False):
+                version = None
+            rendered = await asyncio.to_thread(
+                rank_and_render, query, results, version, page, mode
+            )
+    return search_template + rendered
+
+
+async def stream_search(send, query, mode=SEARCH_MODE, page=1):
+    """
+    Stream the results of a search as Server-Sent Events.
+
+    The events are the same as those of the /stream route in app.py.
+    """
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        }
+    )
+
+    async def event(name, data):
+        body = server_event(name, data).encode("utf-8")
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+
+    with metrics.request_seconds.time(route="stream"):
+        rendered, version = await asyncio.to_thread(cached_render, query, mode, page)
+        if rendered is None:
+            rows = []
+            async for row in async_search_stream(query, mode, page):
+                rows.append(row)
+                await event("result", {"html": render_result(row)})
+            results = pd.DataFrame(rows)
+            if mode != "local":
+                results.attrs["more"] = await asyncio.to_thread(
+                    storage.page_more, query, page
+                )
+            rendered = await asyncio.to_thread(
+                rank_and_render, query, results, version, page, mode
+            )
+        await event("done", {"html": rendered})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def lifespan(receive, send):
+    """
+    Handle the ASGI lifespan protocol: prepare the database at startup
+    and close the HTTP client at shutdown.
+
+    The tables are set up and migrated before the server takes requests,
+    so a migration does not hold up the first search. If that fails, the
+    startup fails with the error.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await asyncio.to_thread(storage.prepare)
+            except Exception as error:
+                await send({"type": "lifespan.startup.failed", "message": str(error)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await get_client().aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI application.
+    """
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    path = scope["path"]
+    args = parse_qs(scope["query_string"].decode("latin-1"))
+    if path == "/" and method == "GET" and "query" not in args:
+        await respond(send, 200, show_search_form())
+    elif path == "/" and method in ("GET", "POST"):
+        if method == "POST":
+            args = parse_qs((await read_body(receive)).decode("utf-8"))
+        query = args.get("query", [""])[0]
+        mode = args.get("mode", [SEARCH_MODE])[0]
+        page = parse_page(args.get("page", [None])[0])
+        await respond(send, 200, await run_search(query, mode, page))
+    elif path == "/stream" and method == "GET":
+        query = args.get("query", [""])[0]
+        mode = args.get("mode", [SEARCH_MODE])[0]
+        page = parse_page(args.get("page", [None])[0])
+        await stream_search(send, query, mode, page)
+    elif path == "/relevant" and method == "POST":
+        try:
+            data = json.loads(await read_body(receive))
+            query, link = str(data["query"]), str(data["link"])
+        except (ValueError, KeyError, TypeError):
+            await respond(send, 400, "Bad Request", "text/plain")
+            return
+        await asyncio.to_thread(storage.update_relevance, query, link, 10)
+        await respond(send, 200, json.dumps({"success": True}), "application/json")
+    elif path.startswith("/assets/") and method == "GET":
+        asset = assets.get(path[len("/assets/") :])
+        if asset is None:
+            await respond(send, 404, "Not Found", "text/plain")
+        else:
+            cache = f"public, max-age={ASSET_MAX_AGE}, immutable"
+            await respond(send, 200, *asset, [("cache-control", cache)])
+    elif path == "/metrics" and method == "GET":
+        await respond(send, 200, metrics.render(), metrics.CONTENT_TYPE)
+    elif path in ("/", "/stream", "/relevant", "/metrics"):
+        await respond(send, 405, "Method Not Allowed", "text/plain")
+    else:
+        await respond(send, 404, "Not Found", "text/plain")
@@ -0,0 +1,267 @@
+"""
+Offline benchmark of the search pipeline.
+
+Runs every stage of a search against the local stand-in in standin.py, in
+a scratch directory with its own database and blocklist, so no API key,
+network access or existing links.db is needed. Run it from the
+zero-search-engine directory:
+
+    python benchmark/bench.py
+    python benchmark/bench.py --save baseline.json
+    python benchmark/bench.py --compare baseline.json --tolerance 0.25
+
+For each stage the median time of --repeat runs, the throughput and the
+peak traced memory of one more run are reported. Cold stages start from
+an empty database and render cache; warm stages repeat a query whose
+results are stored. With --compare, the exit status is non-zero when a
+stage is slower than in the baseline by more than the tolerance.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from standin import FIXTURES, StandInServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ENGINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERIES = ["python asyncio tutorial", "sqlite full text search", "privacy friendly browser"]
+REPEAT = 5
+API_LATENCY = 0.05
+PAGE_LATENCY = 0.05
+TOLERANCE = 0.25
+
+
+def quiet():
+    """
+    Silence the progress output of the pipeline.
+    """
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def measure(run, items, repeat=REPEAT, setup=None):
+    """
+    Time a stage and trace its memory use.
+
+    Parameters
+    ----------
+    run : callable
+        The stage, called without arguments.
+    items : int
+        The number of items (queries, pages or rows) one call handles.
+    repeat : int
+        The number of timed calls.
+    setup : callable
+        Optional function called, untimed, before every call.
+
+    Returns
+    -------
+    dict
+        The median seconds per call, the items per second and the peak
+        traced memory in KiB.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with quiet():
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    with quiet():
+        run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds = statistics.median(times)
+    return {
+        "items": items,
+        "seconds": seconds,
+        "throughput": items / seconds if seconds > 0 else float("inf"),
+        "peak_kib": peak / 1024,
+    }
+
+
+def run_benchmark(repeat=REPEAT, api_latency=API_LATENCY, page_latency=PAGE_LATENCY):
+    """
+    Run every stage of the pipeline against the stand-in.
+
+    Must run with a scratch directory as the working directory, before
+    the engine modules are imported elsewhere, since they read their
+    settings and open their files relative to it.
+
+    Returns
+    -------
+    dict
+        The measurements of measure() by stage name.
+    """
+    import search
+    import pages
+    from filter import Filter, ranking_features
+    from storage import DBStorage
+
+    server = StandInServer(0, api_latency, page_latency).start()
+    search.SEARCH_URL = server.search_url
+    search.API_DAILY_QUOTA = 10**9
+    storage = DBStorage()
+
+    def reset():
+        storage.evict(0)
+        pages.rendered_results.clear()
+
+    def clear_api_cache():
+        with storage.con:
+            storage.con.execute("DELETE FROM api_responses")
+
+    def run_queries(run):
+        return lambda: [run(query) for query in QUERIES]
+
+    def full_search(query):
+        version = storage.page_version(query)
+        return pages.rank_and_render(query, search.search(query), version)
+
+    with quiet():
+        api_results = {query: search.search_api(query) for query in QUERIES}
+        links = [link for df in api_results.values() for link in df["link"]]
+        html = search.scrape_page(links)
+        fetched = {query: search.fetch_results(query) for query in QUERIES}
+    rows = {
+        query: list(df.itertuples(index=False, name=None)) for query, df in fetched.items()
+    }
+    row_count = sum(len(r) for r in rows.values())
+
+    stages = {}
+    stages["api"] = measure(
+        run_queries(search.search_api), len(QUERIES), repeat, setup=clear_api_cache
+    )
+    stages["api cached"] = measure(run_queries(search.search_api), len(QUERIES), repeat)
+    stages["scrape"] = measure(lambda: search.scrape_page(links), len(links), repeat)
+    stages["features"] = measure(
+        lambda: [ranking_features(page) for page in html], len(html), repeat
+    )
+    stages["store"] = measure(
+        lambda: [storage.replace_results(q, r) for q, r in rows.items()],
+        row_count,
+        repeat,
+        setup=reset,
+    )
+    stages["cold query"] = measure(
+        run_queries(full_search), len(QUERIES), repeat, setup=reset
+    )
+    stages["revalidate"] = measure(
+        run_queries(search.fetch_results), len(QUERIES), repeat
+    )
+    stages["next page"] = measure(
+        run_queries(
+            lambda query: pages.rank_and_render(query, search.search(query, page=2), page=2)
+        ),
+        len(QUERIES),
+        repeat,
+        setup=reset,
+    )
+
+    with quiet():
+        stored = {query: search.search(query) for query in QUERIES}
+    ranked = {query: Filter(df).ranking() for query, df in stored.items()}
+    stages["lookup"] = measure(
+        run_queries(lambda query: search.stored_or_none(storage, query)),
+        len(QUERIES),
+        repeat,
+    )
+    stages["filter"] = measure(
+        lambda: [Filter(df).ranking() for df in stored.values()], row_count, repeat
+    )
+    stages["render"] = measure(
+        lambda: [pages.render_results(stored[q], ranked[q]) for q in QUERIES],
+        row_count,
+        repeat,
+    )
+    stages["local index"] = measure(
+        run_queries(storage.local_results), len(QUERIES), repeat
+    )
+    stages["warm query"] = measure(
+        run_queries(full_search),
+        len(QUERIES),
+        repeat,
+        setup=pages.rendered_results.clear,
+    )
+    stages["cached query"] = measure(
+        run_queries(pages.cached_render), len(QUERIES), repeat
+    )
+    server.shutdown()
+    return stages
+
+
+def report(stages, baseline=None, tolerance=TOLERANCE):
+    """
+    Print the measurements, compared with a baseline if one is given.
+
+    Returns
+    -------
+    regressions : list
+        The stages slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+    print(f"{'stage':<14}{'items':>7}{'median ms':>12}{'items/s':>12}{'peak KiB':>11}  change")
+    for name, stage in stages.items():
+        change = ""
+        if baseline and name in baseline:
+            ratio = stage["seconds"] / baseline[name]["seconds"] - 1
+            change = f"{ratio:+.0%}"
+            if ratio > tolerance:
+                change += " REGRESSION"
+                regressions.append(name)
+        print(
+            f"{name:<14}{stage['items']:>7}{stage['seconds'] * 1000:>12.2f}"
+            f"{stage['throughput']:>12.1f}{stage['peak_kib']:>11.0f}  {change}"
+        )
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"max RSS: {max_rss / 1024:.0f} MiB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--api-latency", type=float, default=API_LATENCY)
+    parser.add_argument("--page-latency", type=float, default=PAGE_LATENCY)
+    parser.add_argument("--save", help="write the measurements to this JSON file")
+    parser.add_argument("--compare", help="compare with measurements saved earlier")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    options = parser.parse_args()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    save = os.path.abspath(options.save) if options.save else None
+
+    workdir = tempfile.mkdtemp(prefix="zero-bench-")
+    try:
+        shutil.copy(os.path.join(FIXTURES, "blacklist.txt"), workdir)
+        os.chdir(workdir)
+        sys.path.insert(0, ENGINE)
+        stages = run_benchmark(options.repeat, options.api_latency, options.page_latency)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = report(stages, baseline, options.tolerance)
+    if save:
+        with open(save, "w") as f:
+            json.dump(stages, f, indent=1)
+    sys.exit(1 if regressions else 0)
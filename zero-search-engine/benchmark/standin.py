@@ -0,0 +1,162 @@
+"""
+Local stand-in for the Google Custom Search API and the pages it links to.
+
+Serves the recorded API responses in fixtures/api and the HTML pages in
+fixtures/pages, each after a configurable delay, so searches can run on
+a machine without network access or an API key. Point SEARCH_URL at it:
+
+    python benchmark/standin.py --port 8799 --api-latency 0.2 --page-latency 0.1
+
+    SEARCH_URL = "http://127.0.0.1:8799/customsearch/v1?key={key}&cx={cx}&q={query}&start={start}&num=10"
+
+A response for query q and start index s is read from
+fixtures/api/<q with spaces as dashes>-<s>.json; "{base}" and "{host}" in
+it are replaced by the address of the stand-in. A query without a
+recording gets an empty result, like a search without hits. Pages carry
+an ETag and answer a matching If-None-Match with "304 Not Modified". A
+"delay" parameter on any request overrides its latency.
+"""
+
+import argparse
+import hashlib
+import http.server
+import os
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+API_LATENCY = 0.2
+PAGE_LATENCY = 0.1
+EMPTY_RESPONSE = b'{"kind": "customsearch#search", "searchInformation": {"totalResults": "0"}}'
+
+
+def recording_name(query, start):
+    """
+    Return the file name of the recorded response for a query.
+    """
+    return f"{'-'.join(query.lower().split())}-{start}.json"
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = parse_qs(url.query)
+        etag = None
+        if url.path == "/customsearch/v1":
+            latency = self.server.api_latency
+            body, content_type = self.api_response(args), "application/json"
+        elif url.path.startswith("/pages/"):
+            latency = self.server.page_latency
+            body = self.page(url.path[len("/pages/") :])
+            content_type = "text/html; charset=utf-8"
+            if body is not None:
+                etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        else:
+            body = None
+        if "delay" in args:
+            latency = float(args["delay"][0])
+        if body is None:
+            self.send_error(404)
+            return
+        if latency > 0:
+            time.sleep(latency)
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def api_response(self, args):
+        query = args.get("q", [""])[0]
+        start = args.get("start", ["1"])[0]
+        path = os.path.join(self.server.fixtures, "api", recording_name(query, start))
+        if not os.path.exists(path):
+            return EMPTY_RESPONSE
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        host = f"{self.server.server_address[0]}:{self.server.server_address[1]}"
+        text = text.replace("{base}", f"http://{host}").replace("{host}", host)
+        return text.encode("utf-8")
+
+    def page(self, name):
+        path = os.path.join(self.server.fixtures, "pages", os.path.basename(name))
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Threaded HTTP server for the stand-in.
+
+    Parameters
+    ----------
+    port : int
+        The port to listen on; 0 picks a free one.
+    api_latency : float
+        Seconds to wait before answering an API request.
+    page_latency : float
+        Seconds to wait before answering a page request.
+    fixtures : str
+        The directory with the api and pages fixtures.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(
+        self, port=0, api_latency=API_LATENCY, page_latency=PAGE_LATENCY, fixtures=FIXTURES
+    ):
+        super().__init__(("127.0.0.1", port), StandInHandler)
+        self.api_latency = api_latency
+        self.page_latency = page_latency
+        self.fixtures = fixtures
+
+    @property
+    def search_url(self):
+        """
+        The SEARCH_URL that points at this server.
+        """
+        host, port = self.server_address
+        return (
+            f"http://{host}:{port}/customsearch/v1"
+            "?key={key}&cx={cx}&q={query}&start={start}&num=10"
+        )
+
+    def start(self):
+        """
+        Serve requests in a daemon thread.
+
+        Returns
+        -------
+        StandInServer
+            The server itself.
+        """
+        threading.Thread(target=self.serve_forever, name="stand-in", daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--api-latency", type=float, default=API_LATENCY)
+    parser.add_argument("--page-latency", type=float, default=PAGE_LATENCY)
+    options = parser.parse_args()
+    server = StandInServer(options.port, options.api_latency, options.page_latency)
+    print(f"Serving on {server.search_url}")
+    server.serve_forever()
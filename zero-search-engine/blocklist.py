@@ -0,0 +1,220 @@
+import os
+import sys
+import zlib
+from settings import *
+
+MAGIC = b"ZBL1"
+HOSTS_ADDRESSES = {"0.0.0.0", "127.0.0.1", "::", "::1"}
+
+
+def normalize_domain(domain):
+    """
+    Return a domain in the form used by the index: lower case, without
+    surrounding whitespace or a trailing dot.
+    """
+    return domain.strip().lower().rstrip(".")
+
+
+def parse_blocklist(text):
+    """
+    Parse the domains out of a blocklist.
+
+    Besides one domain per line (the format of blacklist.txt), the common
+    public list formats are understood: hosts files ("0.0.0.0 domain"),
+    Adblock-style domain rules ("||domain^") and "#" or "!" comments.
+    Entries without a dot are skipped, so a stray "localhost" or "com"
+    does not block every host under it.
+
+    Parameters
+    ----------
+    text : str
+        The contents of the blocklist.
+
+    Returns
+    -------
+    domains : set
+        The normalized domains in the list.
+    """
+    domains = set()
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line or line.startswith("!"):
+            continue
+        if line.startswith("||"):
+            line = line[2:].split("^", 1)[0]
+        parts = line.split()
+        if len(parts) > 1 and parts[0] in HOSTS_ADDRESSES:
+            parts = parts[1:]
+        for part in parts:
+            domain = normalize_domain(part)
+            if "." in domain and domain not in HOSTS_ADDRESSES:
+                domains.add(domain)
+    return domains
+
+
+class DomainIndex:
+    """
+    Set of blocked domains that also matches their subdomains.
+
+    A hostname matches when it, or any of its parent domains, is in the
+    list, so "ads.tracker.com" matches a listed "tracker.com". A lookup
+    is one hash probe per label of the hostname.
+    """
+
+    def __init__(self, domains=()):
+        self.domains = frozenset(normalize_domain(d) for d in domains if d)
+
+    def __len__(self):
+        return len(self.domains)
+
+    def __contains__(self, host):
+        return self.match(host)
+
+    def match(self, host):
+        """
+        Return True if the hostname or one of its parent domains is listed.
+
+        Parameters
+        ----------
+        host : str
+            The hostname to check, e.g. "ads.tracker.com".
+
+        Returns
+        -------
+        bool
+            Whether the hostname is blocked.
+        """
+        if not host:
+            return False
+        host = host.lower().rstrip(".")
+        domains = self.domains
+        start = 0
+        while True:
+            if host[start:] in domains:
+                return True
+            start = host.find(".", start) + 1
+            if start == 0:
+                return False
+
+    def to_bytes(self):
+        """
+        Serialize the index to its compiled binary form.
+
+        The format is the MAGIC header followed by the zlib-compressed,
+        sorted, newline-separated domains.
+
+        Returns
+        -------
+        bytes
+            The compiled index.
+        """
+        body = "\n".join(sorted(self.domains)).encode("utf-8")
+        return MAGIC + zlib.compress(body, 9)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load an index from its compiled binary form.
+
+        Parameters
+        ----------
+        data : bytes
+            Data produced by to_bytes.
+
+        Returns
+        -------
+        DomainIndex
+            The loaded index.
+        """
+        if not data.startswith(MAGIC):
+            raise ValueError("Not a compiled blocklist.")
+        body = zlib.decompress(data[len(MAGIC) :]).decode("utf-8")
+        index = cls()
+        index.domains = frozenset(body.split("\n")) if body else frozenset()
+        return index
+
+
+def read_blocklist(source=BLACKLIST_PATH):
+    """
+    Parse a text blocklist into an index.
+
+    Parameters
+    ----------
+    source : str
+        Path of the text blocklist.
+
+    Returns
+    -------
+    DomainIndex
+        The index of the listed domains.
+    """
+    with open(source, encoding="utf-8", errors="replace") as f:
+        return DomainIndex(parse_blocklist(f.read()))
+
+
+def compile_blocklist(source=BLACKLIST_PATH, target=BLACKLIST_CACHE):
+    """
+    Parse a text blocklist and write its compiled binary form.
+
+    Parameters
+    ----------
+    source : str
+        Path of the text blocklist.
+    target : str
+        Path of the compiled file to write.
+
+    Returns
+    -------
+    DomainIndex
+        The compiled index.
+    """
+    index = read_blocklist(source)
+    with open(target, "wb") as f:
+        f.write(index.to_bytes())
+    return index
+
+
+def load_blocklist(source=BLACKLIST_PATH, cache=BLACKLIST_CACHE):
+    """
+    Load the tracker blocklist, preferring its compiled form.
+
+    The compiled file is used when it is at least as new as the text
+    list; otherwise the text list is parsed and the compiled file is
+    rewritten. A compiled file on its own is enough to run with.
+
+    Parameters
+    ----------
+    source : str
+        Path of the text blocklist.
+    cache : str
+        Path of the compiled blocklist.
+
+    Returns
+    -------
+    DomainIndex
+        The index of blocked domains.
+    """
+    if os.path.exists(cache) and (
+        not os.path.exists(source)
+        or os.path.getmtime(cache) >= os.path.getmtime(source)
+    ):
+        try:
+            with open(cache, "rb") as f:
+                return DomainIndex.from_bytes(f.read())
+        except (OSError, ValueError, zlib.error):
+            pass
+    index = read_blocklist(source)
+    try:
+        with open(cache, "wb") as f:
+            f.write(index.to_bytes())
+    except OSError:
+        pass
+    return index
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    source = args[0] if len(args) > 0 else BLACKLIST_PATH
+    target = args[1] if len(args) > 1 else BLACKLIST_CACHE
+    index = compile_blocklist(source, target)
+    print(f"Compiled {len(index)} domains into {target}.")
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded in-memory cache with least-recently-used
+    eviction and an optional time to live per entry.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for a key and mark it as recently used.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to look up.
+        default : object
+            The value returned when the key is missing or expired.
+
+        Returns
+        -------
+        object
+            The cached value, or default.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Cache a value, evicting the least recently used entries if full.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to store the value under.
+        value : object
+            The value to cache.
+
+        Returns
+        -------
+        None
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove a key from the cache, if it is there.
+
+        Returns
+        -------
+        None
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+
+        Returns
+        -------
+        None
+        """
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,95 @@
+"""
+Import-time budget check for the search service.
+
+Imports each entry point in a fresh interpreter and fails when the
+import takes longer than the budget, or when it pulls in one of the
+heavy dependencies that are meant to load on first use. Run it from
+this directory:
+
+    python check_startup.py [budget in seconds]
+
+The exit status is non-zero when a check fails.
+"""
+
+import subprocess
+import sys
+
+MODULES = ["app", "asgi"]
+DEFERRED = ["pandas", "numpy", "httpx"]
+BUDGET = 0.5
+RUNS = 3
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {deferred!r} if name in sys.modules]
+print(elapsed, ",".join(loaded))
+"""
+
+
+def import_time(module):
+    """
+    Import a module in a fresh interpreter.
+
+    Parameters
+    ----------
+    module : str
+        The name of the module to import.
+
+    Returns
+    -------
+    elapsed : float
+        The time the import took, in seconds.
+    loaded : list
+        The deferred dependencies that the import loaded.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, deferred=DEFERRED)],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    elapsed = float(output[0])
+    loaded = output[1].split(",") if len(output) > 1 else []
+    return elapsed, loaded
+
+
+def check(budget=BUDGET, runs=RUNS):
+    """
+    Check the import time of every entry point against the budget.
+
+    The fastest of several runs is used, so a busy machine does not fail
+    the check on its own.
+
+    Parameters
+    ----------
+    budget : float
+        The maximum import time, in seconds.
+    runs : int
+        The number of imports to time per module.
+
+    Returns
+    -------
+    bool
+        Whether every module is within the budget.
+    """
+    ok = True
+    for module in MODULES:
+        timings = [import_time(module) for _ in range(runs)]
+        elapsed = min(t for t, _ in timings)
+        loaded = timings[0][1]
+        problems = []
+        if elapsed > budget:
+            problems.append(f"over budget ({budget:.3f}s)")
+        if loaded:
+            problems.append(f"imports {', '.join(loaded)} at start-up")
+        ok = ok and not problems
+        print(f"{module}: {elapsed:.3f}s {'; '.join(problems) or 'ok'}")
+    return ok
+
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET
+    sys.exit(0 if check(budget) else 1)
@@ -1,127 +1,336 @@
-from bs4 import BeautifulSoup
+import threading
+from collections import namedtuple
+from html.parser import HTMLParser
 from urllib.parse import urlparse
 from settings import *
+from blocklist import load_blocklist
+from lazy import lazy_import
+from metrics import stage_seconds
 
-with open("blacklist.txt") as f:
-    domains = set(f.read().split("\n"))
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
 
+_domains = None
+_domains_lock = threading.Lock()
 
-def tracker_urls(row):
+
+def get_domains():
+    """
+    Return the index of blocked domains, loading it on first use.
+
+    The blocklist is read from its compiled form when that is up to
+    date, so only the first page that is scored pays for it.
+
+    Returns
+    -------
+    DomainIndex
+        The index of blocked domains.
+    """
+    global _domains
+    if _domains is None:
+        with _domains_lock:
+            if _domains is None:
+                _domains = load_blocklist()
+    return _domains
+
+
+PageFeatures = namedtuple("PageFeatures", ["hosts", "text", "word_count"])
+
+
+class FeatureParser(HTMLParser):
+    """
+    Streaming HTML tokenizer that collects everything the filters need
+    from a page in a single pass: the hostnames of <script src> and
+    <a href> targets, and the visible text.
     """
-    Return the number of known trackers found in the given row of data.
 
-    The function works by finding all <script> tags with a src attribute
-    and all <a> tags with an href attribute. It then extracts the hostname
-    from the src and href attributes and checks if the hostname is in the
-    list of known tracker domains.
+    hidden_tags = {"script", "style", "noscript", "template"}
+
+    def __init__(self):
+        super().__init__()
+        self.hosts = []
+        self.chunks = []
+        self.hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.hidden_tags:
+            self.hidden += 1
+        if tag == "script":
+            url = dict(attrs).get("src")
+        elif tag == "a":
+            url = dict(attrs).get("href")
+        else:
+            return
+        if url:
+            try:
+                host = urlparse(url).hostname
+            except ValueError:
+                return
+            if host:
+                self.hosts.append(host)
+
+    def handle_endtag(self, tag):
+        if tag in self.hidden_tags and self.hidden > 0:
+            self.hidden -= 1
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.chunks.append(data)
+
+
+def extract_features(html):
+    """
+    Parse a page once and return the features used for ranking.
 
     Parameters
     ----------
-    row : pandas Series
-        A row of data containing an "html" column.
+    html : str
+        The HTML of the page.
 
     Returns
     -------
-    int
-        The number of known trackers found in the given row of data.
+    PageFeatures
+        A record with the script/anchor hostnames ("hosts"), the visible
+        text with whitespace collapsed ("text") and its number of words
+        ("word_count").
+    """
+    parser = FeatureParser()
+    parser.feed(html or "")
+    parser.close()
+    words = " ".join(parser.chunks).split()
+    return PageFeatures(parser.hosts, " ".join(words), len(words))
+
 
+def tracker_urls(features):
     """
-    soup = BeautifulSoup(row["html"])
-    scripts = soup.find_all("script", {"src": True})
-    srcs = [s.get("src") for s in scripts]
+    Return the number of known trackers found in the given page features.
+
+    The function checks the hostnames of all <script src> and <a href>
+    targets on the page against the list of known tracker domains. A
+    subdomain of a listed domain counts as a tracker too.
+
+    Parameters
+    ----------
+    features : PageFeatures
+        The features extracted from a page by extract_features.
 
-    links = soup.find_all("a", {"href": True})
-    href = [l.get("href") for l in links]
+    Returns
+    -------
+    int
+        The number of known trackers found on the page.
 
-    all_domains = [urlparse(s).hostname for s in srcs + href]
-    return len([a for a in all_domains if a in domains])
+    """
+    domains = get_domains()
+    return len([a for a in features.hosts if a in domains])
 
 
-def get_page_content(row):
+def ranking_features(html):
     """
-    Return the text content of the given row of data.
+    Return the precomputed ranking features of a page.
 
-    The function works by parsing the HTML content of the given row of data
-    and extracting all the text content.
+    These are the values stored alongside each result, so that cached
+    results can be ranked without parsing their HTML again.
 
     Parameters
     ----------
-    row : pandas Series
-        A row of data containing an "html" column.
+    html : str
+        The HTML of the page.
 
     Returns
     -------
-    str
-        The text content of the given row of data.
+    tuple
+        (tracker_count, word_count, text) for the page.
+    """
+    features = extract_features(html)
+    return tracker_urls(features), features.word_count, features.text
+
+
+def tracker_score(features):
+    """
+    Penalize pages based on the presence of tracker URLs.
+
+    Each page is penalized by twice its number of tracker URLs, and pages
+    with more trackers than the median by twice RESULT_COUNT, which
+    pushes them to the bottom of the results.
+    """
+    tracker_count = features["tracker_count"]
+    tracker_count = np.where(
+        tracker_count > np.median(tracker_count), RESULT_COUNT, tracker_count
+    )
+    return tracker_count * 2
+
+
+def content_score(features):
+    """
+    Penalize pages based on the length of their content.
 
+    Pages with less than half the median number of words are penalized
+    by RESULT_COUNT; all other pages are left as they are.
     """
-    soup = BeautifulSoup(row["html"])
-    text = soup.get_text()
-    return text
+    word_count = features["word_count"] / np.median(features["word_count"])
+    return np.where(word_count <= 0.5, RESULT_COUNT, 0)
+
+
+def feedback_score(features):
+    """
+    Boost pages based on the relevance feedback for their links.
+
+    FEEDBACK_WEIGHT times the logarithm of the feedback score is
+    subtracted, so a few clicks move a result up noticeably while many
+    clicks cannot bury every other result.
+    """
+    return -FEEDBACK_WEIGHT * np.log1p(features["feedback"])
+
+
+SCORERS = [tracker_score, content_score, feedback_score]
+
+
+def register_scorer(scorer):
+    """
+    Add a scorer to the ones every Filter applies.
+
+    A scorer takes the dict of feature arrays built by Filter.features
+    (one NumPy array per feature, one entry per result) and returns an
+    array of rank adjustments: positive values move a result down,
+    negative values move it up.
+
+    Parameters
+    ----------
+    scorer : callable
+        The scorer to add.
+
+    Returns
+    -------
+    callable
+        The scorer, so this can be used as a decorator.
+    """
+    SCORERS.append(scorer)
+    return scorer
 
 
 class Filter:
-    def __init__(self, results):
-        self.filtered = results.copy()
+    def __init__(self, results, feedback=None, scorers=None):
+        self.filtered = results
+        self.feedback = feedback
+        self.scorers = SCORERS if scorers is None else scorers
+        self.parsed = None
+
+    def page_features(self):
+        """
+        Return the features of every page, parsing each page only once.
 
-    def tracker_filter(self):
+        Returns
+        -------
+        features : list
+            A PageFeatures record for each row of the results.
         """
-        Filter results based on the presence of tracker URLs.
+        if self.parsed is None:
+            self.parsed = [extract_features(html) for html in self.filtered["html"]]
+        return self.parsed
 
-        The function works by counting the number of tracker URLs in each row
-        of the given DataFrame and then adding this count to the "rank" column.
-        The count is multiplied by two to have a greater impact on the ranking.
+    def feature_column(self, column, compute):
+        """
+        Return a precomputed feature column, or compute it from the HTML.
 
-        The function also replaces rows with a high number of tracker URLs with
-        a special value indicating that the row should be filtered out.
+        Results loaded from the database carry their ranking features, so
+        the HTML is only parsed for results that do not have them.
 
         Parameters
         ----------
-        None
+        column : str
+            The name of the precomputed column, e.g. "tracker_count".
+        compute : callable
+            Function mapping a PageFeatures record to the feature value.
 
         Returns
         -------
-        None
+        values : numpy.ndarray
+            The feature value for each row of the results.
         """
-        tracker_count = self.filtered.apply(tracker_urls, axis=1)
-        tracker_count[tracker_count > tracker_count.median()] = RESULT_COUNT
-        self.filtered["rank"] += tracker_count * 2
+        if column in self.filtered.columns:
+            values = self.filtered[column].to_numpy(dtype=float, na_value=np.nan)
+            if not np.isnan(values).any():
+                return values
+        return np.array([compute(f) for f in self.page_features()], dtype=float)
 
-    def content_filter(self):
+    def features(self):
         """
-        Filter results based on the length of the content on each page.
+        Build the feature arrays the scorers work on.
 
-        The function works by counting the number of words on each page and
-        then adding this count to the "rank" column. The count is divided by
-        the median count to normalise the values. Any page with a word count
-        of less than half the median is given a special value indicating that
-        the row should be filtered out.
+        Returns
+        -------
+        features : dict
+            "rank", "tracker_count", "word_count" and "feedback", each a
+            float array with one entry per result.
+        """
+        feedback = np.zeros(self.filtered.shape[0])
+        if self.feedback is not None and len(self.feedback) > 0:
+            links = pd.Index(self.filtered["link"])
+            if self.feedback.index.equals(links):
+                feedback = self.feedback.to_numpy(dtype=float, na_value=0.0)
+            else:
+                feedback = self.feedback.reindex(links).to_numpy(
+                    dtype=float, na_value=0.0
+                )
+        return {
+            "rank": self.filtered["rank"].to_numpy(dtype=float),
+            "tracker_count": self.feature_column("tracker_count", tracker_urls),
+            "word_count": self.feature_column("word_count", lambda x: x.word_count),
+            "feedback": feedback,
+        }
+
+    def score(self, features):
+        """
+        Run every scorer over the features and add up their adjustments.
 
         Parameters
         ----------
-        None
+        features : dict
+            The feature arrays, as built by features().
 
         Returns
         -------
-        None
+        rank : numpy.ndarray
+            The adjusted rank of each result.
+        """
+        rank = features["rank"].copy()
+        for scorer in self.scorers:
+            rank += scorer(features)
+        return rank
+
+    def ranking(self):
         """
-        page_content = self.filtered.apply(get_page_content, axis=1)
-        word_count = page_content.apply(lambda x: len(x.split(" ")))
+        Rank the results and return their order, without reordering them.
 
-        word_count /= word_count.median()
-        word_count[word_count <= 0.5] = RESULT_COUNT
-        word_count[word_count != RESULT_COUNT] = 0
-        self.filtered["rank"] += word_count
+        This function builds the feature arrays of the results, runs every
+        scorer over them at once, and sorts the results by the adjusted
+        rank, which is rounded to the nearest integer. By default the
+        scorers are the tracker, content and feedback scorers, in this
+        order. Only the order is computed, so a caller that shows a few
+        columns can reorder just those (see pages.render_results).
+
+        Returns
+        -------
+        order : numpy.ndarray
+            The positions of the results, best first.
+        rank : numpy.ndarray
+            The rounded adjusted rank of each result, in that order.
+        """
+        if self.filtered.shape[0] == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        with stage_seconds.time(stage="features"):
+            features = self.features()
+        with stage_seconds.time(stage="rank"):
+            rank = self.score(features)
+            order = np.argsort(rank, kind="stable")
+        return order, np.round(rank[order])
 
     def filter(self):
         """
-        Apply all filters to the given DataFrame.
+        Rank the results and return them sorted.
 
-        This function applies the tracker filter and the content filter to the
-        given DataFrame. The filters are applied in this order, meaning that the
-        tracker filter is applied first and the content filter is applied
-        afterwards. The filtered DataFrame is then sorted by the rank column
-        and the rank is rounded to the nearest integer.
+        The results are ordered by ranking(), and their "rank" column is
+        replaced with the adjusted rank.
 
         Parameters
         ----------
@@ -132,8 +341,9 @@ class Filter:
         filtered : DataFrame
             The filtered DataFrame.
         """
-        self.tracker_filter()
-        self.content_filter()
-        self.filtered = self.filtered.sort_values("rank", ascending=True)
-        self.filtered["rank"] = self.filtered["rank"].round()
+        if self.filtered.shape[0] == 0:
+            return self.filtered.copy()
+        order, rank = self.ranking()
+        self.filtered = self.filtered.take(order)
+        self.filtered["rank"] = rank
         return self.filtered
@@ -0,0 +1,52 @@
+import importlib
+import sys
+import threading
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    Heavy dependencies such as pandas, numpy and httpx take most of the
+    start-up time of the service but are only needed once a search runs,
+    so the modules that use them bind a LazyModule in their place.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name):
+    """
+    Return a module, deferring its import until it is first used.
+
+    Parameters
+    ----------
+    name : str
+        The absolute name of the module, e.g. "pandas".
+
+    Returns
+    -------
+    module or LazyModule
+        The module itself if it is already imported, otherwise a
+        LazyModule that imports it on first attribute access.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,89 @@
+"""
+Structured logging for the search engine.
+
+The modules log through the standard logging package, with the details
+of an event passed as extra fields, e.g.
+
+    logger.info("stored results", extra={"query": query, "count": 20})
+
+configure_logging() sends the records to stderr, one JSON object per line
+by default (LOG_FORMAT = "json"), or as plain text (LOG_FORMAT = "text").
+"""
+
+import json
+import logging
+import time
+from settings import *
+
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+QUIET_LOGGERS = ["httpx", "httpcore"]
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format a log record as one JSON object, including its extra fields.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_FIELDS and not name.startswith("_"):
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Format a log record as text, with its extra fields as key=value pairs.
+    """
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = [
+            f"{name}={value}"
+            for name, value in vars(record).items()
+            if name not in RECORD_FIELDS and not name.startswith("_")
+        ]
+        return " ".join([text] + fields)
+
+
+def configure_logging(level=LOG_LEVEL, format=LOG_FORMAT):
+    """
+    Send the log records of the search engine to stderr.
+
+    Nothing is changed if the root logger already has a handler, e.g.
+    one installed by the server running the app. The HTTP client's own
+    per-request records are only shown from WARNING up; the fetches are
+    logged, with their details, at DEBUG by search.py.
+
+    Parameters
+    ----------
+    level : str
+        The minimum level of the records to show, e.g. "INFO".
+    format : str
+        "json" for one JSON object per line, "text" for plain text.
+
+    Returns
+    -------
+    None
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter() if format == "json" else TextFormatter())
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
@@ -0,0 +1,211 @@
+"""
+Minimal Prometheus metrics for the search engine.
+
+Counters, histograms and callback gauges, kept in memory per process and
+rendered in the Prometheus text format by render(), which the /metrics
+routes of app.py and asgi.py serve.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from settings import *
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+
+
+def escape(value):
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{n}="{escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics: a named family of series, one per
+    combination of label values.
+
+    At most METRICS_MAX_SERIES series are kept per metric; further label
+    combinations are counted under the label value "other", so a label
+    such as the host of a scraped page cannot grow without bound.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def key(self, labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        if key not in self.series and len(self.series) >= METRICS_MAX_SERIES:
+            key = ("other",) * len(self.labels)
+        return key
+
+    def samples(self):
+        """
+        Return the samples of the metric as (suffix, labels, value) tuples.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Add to the counter of the given labels.
+        """
+        with self.lock:
+            key = self.key(labels)
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = list(self.series.items())
+        return [("_total", format_labels(self.labels, key), value) for key, value in series]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        Record one observation, e.g. a duration in seconds.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            key = self.key(labels)
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the time spent in the with block, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self.series.items()]
+        samples = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = format_value(bound if bound == float("inf") else float(bound))
+                samples.append(
+                    ("_bucket", format_labels(self.labels, key, [("le", le)]), cumulative)
+                )
+            samples.append(("_sum", format_labels(self.labels, key), total))
+            samples.append(("_count", format_labels(self.labels, key), cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    """
+    Gauge whose values are read from a function when the metrics are
+    rendered. The function returns (labels, value) pairs, with labels a
+    dict of label values.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels, collect):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def samples(self):
+        return [
+            ("", format_labels(self.labels, self.key(labels)), value)
+            for labels, value in self.collect()
+        ]
+
+
+def render():
+    """
+    Render every metric in the Prometheus text format.
+
+    Returns
+    -------
+    str
+        The text served on /metrics.
+    """
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+stage_seconds = Histogram(
+    "zero_stage_seconds",
+    "Time spent in each stage of a search.",
+    ["stage"],
+)
+fetch_seconds = Histogram(
+    "zero_fetch_seconds",
+    "Time to fetch one page, by host.",
+    ["host"],
+)
+request_seconds = Histogram(
+    "zero_request_seconds",
+    "Time to answer a request, by route.",
+    ["route"],
+)
+cache_requests = Counter(
+    "zero_cache_requests",
+    "Lookups in the API, page, result and render caches, by outcome.",
+    ["cache", "result"],
+)
+upstream_errors = Counter(
+    "zero_upstream_errors",
+    "Failed requests to the search API and to result pages.",
+    ["kind"],
+)
+page_limits = Counter(
+    "zero_page_limits",
+    "Pages skipped or cut short by the download limits, by reason.",
+    ["reason"],
+)
+coalesced_searches = Counter(
+    "zero_coalesced_searches",
+    "Searches served by a fetch of the same query by another search, by where it ran.",
+    ["scope"],
+)
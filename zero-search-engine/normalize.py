@@ -0,0 +1,39 @@
+import unicodedata
+from settings import *
+
+STOPWORDS = frozenset(
+    """
+    a an and are as at be by for from how in is it of on or that the this
+    to was what when where which who why with
+    """.split()
+)
+
+
+def canonical_query(query, sort_terms=None):
+    """
+    Return the canonical cache key of a query.
+
+    The query is NFKC-normalized, case-folded and its whitespace collapsed,
+    so "Python ", "python" and "PYTHON" share one key. With sort_terms,
+    stopwords are dropped and the remaining terms sorted as well, so
+    "the history of python" and "python history" share one key too.
+
+    Parameters
+    ----------
+    query : str
+        The query as typed by the user.
+    sort_terms : bool
+        Whether to drop stopwords and ignore term order. Defaults to
+        QUERY_SORT_TERMS.
+
+    Returns
+    -------
+    key : str
+        The canonical key.
+    """
+    if sort_terms is None:
+        sort_terms = QUERY_SORT_TERMS
+    terms = unicodedata.normalize("NFKC", query or "").casefold().split()
+    if sort_terms:
+        terms = sorted([t for t in terms if t not in STOPWORDS] or terms)
+    return " ".join(terms)
@@ -0,0 +1,528 @@
+"""
+The HTML pages of the search engine and the ranking and rendering of
+results, shared by the Flask app in app.py and the ASGI app in asgi.py.
+"""
+
+from filter import Filter
+from storage import DBStorage, subscribe
+from cache import LRUCache
+from normalize import canonical_query
+from metrics import cache_requests, stage_seconds
+from settings import *
+import hashlib
+import html
+import json
+import string
+from urllib.parse import quote_plus
+
+storage = DBStorage()
+rendered_results = LRUCache(RENDER_CACHE_SIZE, ttl=CACHE_TTL)
+
+
+@subscribe
+def invalidate(key):
+    """
+    Drop the rendered pages of a query whose stored results changed.
+    """
+    for page in range(1, MAX_RESULT_PAGE + 1):
+        rendered_results.invalidate((key, page))
+
+
+stylesheet = """
+    @import url('https://fonts.googleapis.com/css2?family=Fira+Code:wght@300..700&display=swap');
+
+    /* Scrollbar styling */
+    ::-webkit-scrollbar {
+    width: 12px;
+    }
+
+    ::-webkit-scrollbar-track {
+    background: #000000;
+    }
+
+    ::-webkit-scrollbar-thumb {
+    background: #ffff00;
+    border: 3px solid #000000;
+    border-radius: 6px;
+    }
+
+    ::-webkit-scrollbar-thumb:hover {
+    background: #000000;
+    }
+
+    body {
+        font-family: 'Fira Code', monospace;
+        max-width: 800px;
+        margin: 0 auto;
+        padding: 20px;
+        background-color: #000000;
+        color: #FFFFFF;
+    }
+
+    .search-container {
+        display: flex;
+        flex-direction: column;
+        align-items: center;
+        justify-content: center;
+        min-height: 60vh;
+        gap: 20px;
+    }
+
+    .search-form {
+        display: flex;
+        gap: 10px;
+        width: 100%;
+        max-width: 600px;
+    }
+
+    input[type="text"] {
+        flex: 1;
+        padding: 12px 20px;
+        font-family: 'Fira Code', monospace;
+        font-size: 16px;
+        border: 2px solid #00FFFF;
+        border-radius: 25px;
+        background: #000000;
+        color: #FFFFFF;
+        outline: none;
+    }
+
+    input[type="text"]:focus {
+        box-shadow: 0 0 15px rgba(0, 255, 255, 0.5);
+    }
+
+    input[type="submit"] {
+        padding: 12px 30px;
+        font-family: 'Fira Code', monospace;
+        font-size: 16px;
+        background-color: #FFFF00;
+        color: #000000;
+        border: none;
+        border-radius: 25px;
+        cursor: pointer;
+        transition: all 0.3s ease;
+    }
+
+    input[type="submit"]:hover {
+        background-color: #00FFFF;
+    }
+
+    .site {
+        font-size: 14px;
+        color: #00FFFF;
+        margin-bottom: 5px;
+    }
+    
+    .snippet {
+        font-size: 14px;
+        color: #CCCCCC;
+        margin-bottom: 30px;
+        line-height: 1.5;
+    }
+    
+    .rel-button {
+        cursor: pointer;
+        color: #FFFF00;
+        margin-left: 10px;
+        transition: color 0.3s ease;
+    }
+
+    .rel-button:hover {
+        color: #00FFFF;
+    }
+
+    a {
+        color: #FFFFFF;
+        text-decoration: none;
+        font-size: 18px;
+        font-weight: 500;
+        display: block;
+        margin: 10px 0;
+    }
+
+    a:hover {
+        color: #FFFF00;
+    }
+
+    .results-container {
+        margin-top: 40px;
+    }
+
+    .loader-container {
+        display: none;
+        justify-content: center;
+        margin: 40px 0;
+        text-align: center;
+    }
+
+    .loader {
+        color: #FFFF00;
+        font-size: 18px;
+        display: block;
+    }
+
+    .pages {
+        display: flex;
+        justify-content: center;
+        gap: 20px;
+        margin: 20px 0 40px;
+        color: #CCCCCC;
+    }
+
+    .pages a {
+        display: inline;
+        font-size: 16px;
+        margin: 0;
+        color: #FFFF00;
+    }
+"""
+
+script = """
+document.addEventListener('DOMContentLoaded', function() {
+    const searchForm = document.querySelector('.search-form');
+    const loaderContainer = document.querySelector('.loader-container');
+    const loader = document.querySelector('.loader');
+
+    // Create the loading text
+    if (loader) {
+        loader.textContent = 'Fetching search results...';
+    }
+
+    if (searchForm) {
+        searchForm.addEventListener('submit', function(event) {
+            if (loaderContainer) {
+                loaderContainer.style.display = 'flex';
+            }
+            document.querySelectorAll('.results-container, .pages').forEach(function(el) {
+                el.remove();
+            });
+            if (window.EventSource) {
+                event.preventDefault();
+                streamResults(searchForm.querySelector('input[name="query"]').value);
+            }
+        });
+    }
+});
+
+const streamResults = function(query) {
+    const loaderContainer = document.querySelector('.loader-container');
+    const results = document.querySelector('#results');
+    results.innerHTML = '';
+    const source = new EventSource('/stream?query=' + encodeURIComponent(query));
+    source.addEventListener('result', function(event) {
+        if (loaderContainer) {
+            loaderContainer.style.display = 'none';
+        }
+        results.insertAdjacentHTML('beforeend', JSON.parse(event.data).html);
+    });
+    source.addEventListener('done', function(event) {
+        if (loaderContainer) {
+            loaderContainer.style.display = 'none';
+        }
+        results.innerHTML = JSON.parse(event.data).html;
+        source.close();
+    });
+    source.onerror = function() {
+        if (loaderContainer) {
+            loaderContainer.style.display = 'none';
+        }
+        source.close();
+    };
+}
+
+document.addEventListener('click', function(event) {
+    const button = event.target.closest('.rel-button');
+    if (button) {
+        relevant(button.dataset.query, button.dataset.link);
+    }
+});
+
+const relevant = function(query, link){
+    fetch("/relevant", {
+        method: 'POST',
+        headers: {
+          'Accept': 'application/json',
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+           "query": query,
+           "link": link
+          })
+        });
+}
+"""
+
+assets = {
+    "zero.css": (stylesheet, "text/css; charset=utf-8"),
+    "zero.js": (script, "text/javascript; charset=utf-8"),
+}
+asset_version = hashlib.sha1((stylesheet + script).encode("utf-8")).hexdigest()[:12]
+
+search_template = (
+    f"""
+    <link rel="stylesheet" href="/assets/zero.css?v={asset_version}">
+    <script src="/assets/zero.js?v={asset_version}" defer></script>"""
+    + """
+    <title>ZERO Search</title>
+    <div class="search-container">
+        <form action="/" method="post" class="search-form">
+            <input type="text" name="query" placeholder="Search...">
+            <input type="submit" value="Search">
+        </form>
+    </div>
+    <div class="loader-container">
+        <div class="loader"></div>
+    </div>
+    <div id="results"></div>
+    """
+)
+
+pages_template = """
+<div class="pages">{previous}<span>page {page}</span>{next}</div>
+"""
+
+
+class HTMLTemplate:
+    """
+    A str.format template whose {name} fields are HTML-escaped when filled in.
+
+    The template is parsed once, into a format string with positional
+    fields, so filling it in for a row of values is a single format call.
+
+    Parameters
+    ----------
+    text : str
+        The template, with {name} fields and no format specs.
+    """
+
+    def __init__(self, text):
+        self.names = []
+        parts = []
+        for literal, name, _, _ in string.Formatter().parse(text):
+            parts.append(literal.replace("{", "{{").replace("}", "}}"))
+            if name is not None:
+                if name not in self.names:
+                    self.names.append(name)
+                parts.append(f"{{{self.names.index(name)}}}")
+        self.format = "".join(parts).format
+
+    def render(self, values):
+        """
+        Fill in the template from a mapping of field names to values.
+        """
+        return self.format(*[escape(values[name]) for name in self.names])
+
+    def render_rows(self, columns, rows):
+        """
+        Fill in the template for every row and join the results.
+
+        Parameters
+        ----------
+        columns : list
+            The field names of the values in each row.
+        rows : iterable
+            Plain tuples of values, e.g. from DataFrame.itertuples.
+
+        Returns
+        -------
+        str
+            The filled-in template of every row, in order.
+        """
+        indexes = [list(columns).index(name) for name in self.names]
+        fill = self.format
+        return "".join([fill(*[escape(row[i]) for i in indexes]) for row in rows])
+
+
+def escape(value):
+    """
+    Return a value as text that is safe in HTML content and quoted attributes.
+    """
+    return html.escape(str(value), quote=True)
+
+
+page_link_template = HTMLTemplate(
+    '<a href="/?query={query}&amp;mode={mode}&amp;page={page}">{label}</a>'
+)
+
+result_template = HTMLTemplate(
+    """
+<div class="results-container">
+    <p class="site">{rank}: {link} <span class="rel-button" data-query="{query}" data-link="{link}">Relevant</span></p>
+    <a href="{link}">{title}</a>
+    <p class="snippet">{snippet}</p>
+</div>
+"""
+)
+
+
+def show_search_form():
+    """
+    Return the search form HTML.
+    """
+    return search_template
+
+
+def parse_page(value):
+    """
+    Return the page number of a request parameter, from 1 to MAX_RESULT_PAGE.
+
+    A missing or malformed value is page 1.
+    """
+    try:
+        page = int(value)
+    except (TypeError, ValueError):
+        return 1
+    return min(max(page, 1), MAX_RESULT_PAGE)
+
+
+def page_links(query, page, more=True, mode=SEARCH_MODE):
+    """
+    Render the links to the previous and next page of results.
+
+    The links keep the search mode, so paging through local results
+    does not turn into API searches.
+
+    Parameters
+    ----------
+    query : str
+        The query the results are for.
+    page : int
+        The page shown.
+    more : bool
+        Whether there is a next page to link to.
+    mode : str
+        The search mode of the results.
+
+    Returns
+    -------
+    str
+        The HTML of the links.
+    """
+    quoted = quote_plus(query)
+
+    def link(target, label):
+        values = {"query": quoted, "mode": mode, "page": target, "label": label}
+        return page_link_template.render(values)
+
+    return pages_template.format(
+        previous=link(page - 1, "previous") if page > 1 else "",
+        page=page,
+        next=link(page + 1, "more results") if more and page < MAX_RESULT_PAGE else "",
+    )
+
+
+def render_results(results, ranking=None):
+    """
+    Render ranked results as HTML.
+
+    Every field is escaped, and the rows are read as plain tuples and
+    joined once, so the time per result does not grow with the page.
+
+    Parameters
+    ----------
+    results : pandas.DataFrame
+        The results to render, in display order unless a ranking is given.
+    ranking : tuple
+        The (order, rank) of the results, as returned by Filter.ranking;
+        the rows are rendered in that order and with that rank.
+
+    Returns
+    -------
+    str
+        The HTML of the results, without the search form.
+    """
+    with stage_seconds.time(stage="render"):
+        columns = result_template.names
+        rows = results[columns].itertuples(index=False, name=None)
+        if ranking is not None:
+            rows = list(rows)
+            i = columns.index("rank")
+            rows = [
+                rows[at][:i] + (rank,) + rows[at][i + 1 :] for at, rank in zip(*ranking)
+            ]
+        return result_template.render_rows(columns, rows)
+
+
+def render_result(row):
+    """
+    Render one result, given as a dict with the keys of search.COLUMNS.
+    """
+    return result_template.render(row)
+
+
+def cached_render(query, mode=SEARCH_MODE, page=1):
+    """
+    Return the cached rendered results on a page of a query.
+
+    The rendered results are cached per canonical query and page, together
+    with the generation of the stored results they were made from (see
+    Storage.page_version). An entry is only served while that generation
+    is still the stored one, so writes by other processes are seen too,
+    and while the page is younger than CACHE_TTL, so a stale query still
+    reaches search() to be refreshed. Results from the local index are
+    never cached, since they change with every page added to the index.
+
+    Returns
+    -------
+    tuple
+        The rendered results, or None, and the current generation of the
+        page to pass to rank_and_render, or None if it may not be cached.
+        The generation is read before the search, so a write that races
+        with it only costs a miss.
+    """
+    if mode == "local":
+        return None, None
+    version = storage.page_version(query, page)
+    entry = rendered_results.get((canonical_query(query), page))
+    rendered = entry[1] if entry is not None and entry[0] == version else None
+    cache_requests.inc(cache="render", result="miss" if rendered is None else "hit")
+    return rendered, version
+
+
+def rank_and_render(query, results, version=None, page=1, mode=SEARCH_MODE):
+    """
+    Rank results with the filters, render them with the page links and
+    cache the HTML.
+
+    The next page is linked if the API reported one for this page, or, for
+    results that do not say so, such as those from the local index, if the
+    full page is taken to have a next one.
+
+    Parameters
+    ----------
+    query : str
+        The query the results are for.
+    results : pandas.DataFrame
+        The results, as returned by search().
+    version : int
+        The generation of the stored page, as returned by cached_render
+        before the search, or None if the rendering may not be cached.
+    page : int
+        The page the results are on.
+    mode : str
+        The search mode, kept in the page links.
+
+    Returns
+    -------
+    str
+        The rendered results and page links.
+    """
+    if results.shape[0] == 0:
+        return page_links(query, page, False, mode)
+    more = results.attrs.get("more")
+    if more is None:
+        more = results.shape[0] >= RESULT_PAGE_SIZE
+    with stage_seconds.time(stage="feedback"):
+        feedback = storage.feedback_scores(results["link"])
+    ranking = Filter(results, feedback).ranking()
+    rendered = render_results(results, ranking) + page_links(query, page, more, mode)
+    if version is not None:
+        rendered_results.put((canonical_query(query), page), (version, rendered))
+    return rendered
+
+
+def server_event(event, data):
+    """
+    Format one Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -1,44 +1,625 @@
 from settings import *
-import requests
-from requests.exceptions import RequestException
-import pandas as pd
-from storage import DBStorage
-from datetime import datetime
+import asyncio
+import codecs
+import concurrent.futures
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+import weakref
+from collections import namedtuple
+from lazy import lazy_import
+from storage import DBStorage, page_ranks
+from filter import ranking_features
+from normalize import canonical_query
+from metrics import (
+    Gauge,
+    cache_requests,
+    coalesced_searches,
+    fetch_seconds,
+    page_limits,
+    stage_seconds,
+    upstream_errors,
+)
+from datetime import datetime, timezone
 from urllib.parse import quote_plus
 
+try:
+    from zoneinfo import ZoneInfo
 
-def search_api(query, pages=int(RESULT_COUNT / 10)):
+    QUOTA_TIMEZONE = ZoneInfo(API_QUOTA_TIMEZONE)
+except Exception:
+    QUOTA_TIMEZONE = timezone.utc
+
+httpx = lazy_import("httpx")
+pd = lazy_import("pandas")
+
+logger = logging.getLogger(__name__)
+
+META_CHARSET = re.compile(
+    rb"""<meta[^>]+charset\s*=\s*["']?\s*([a-zA-Z0-9_.:-]+)""", re.IGNORECASE
+)
+QUOTA_REASONS = ["dailyLimitExceeded", "quotaExceeded", "rateLimitExceeded"]
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+COLUMNS = [
+    "query",
+    "rank",
+    "link",
+    "title",
+    "snippet",
+    "created",
+    "tracker_count",
+    "word_count",
+]
+STORED_COLUMNS = [
+    "query",
+    "rank",
+    "link",
+    "title",
+    "snippet",
+    "html",
+    "created",
+    "tracker_count",
+    "word_count",
+    "text",
+    "etag",
+    "last_modified",
+]
+
+FetchedPage = namedtuple(
+    "FetchedPage", ["html", "etag", "last_modified", "not_modified"]
+)
+
+_clients = weakref.WeakKeyDictionary()
+_loop = None
+_loop_lock = threading.Lock()
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the HTTP client for the running event loop.
+
+    Each event loop gets one httpx.AsyncClient, so keep-alive connections
+    are reused by every search on that loop. The client opens at most
+    HTTP_MAX_CONNECTIONS connections at a time; further requests wait for
+    a free connection.
+
+    Returns
+    -------
+    client : httpx.AsyncClient
+        The client bound to the running loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(SCRAPE_TIMEOUT, pool=None),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS),
+            follow_redirects=True,
+        )
+        _clients[loop] = client
+    return client
+
+
+def pool_stats():
+    """
+    Return the state of the HTTP connection pools of all clients.
+
+    httpx does not publish pool statistics, so they are read from the
+    httpcore pool behind the client's transport, if it is there.
+
+    Returns
+    -------
+    dict
+        The number of idle and active connections, and of requests that
+        are being sent or are queued for a connection.
+    """
+    stats = dict.fromkeys(["idle", "active", "sending", "queued"], 0)
+    for client in list(_clients.values()):
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        for connection in list(getattr(pool, "connections", [])):
+            stats["idle" if connection.is_idle() else "active"] += 1
+        for request in list(getattr(pool, "_requests", [])):
+            stats["queued" if request.is_queued() else "sending"] += 1
+    return stats
+
+
+Gauge(
+    "zero_http_connections",
+    "Connections in the HTTP connection pools, by state.",
+    ["state"],
+    lambda: [({"state": state}, pool_stats()[state]) for state in ["idle", "active"]],
+)
+Gauge(
+    "zero_http_requests",
+    "Requests in the HTTP connection pools, by state.",
+    ["state"],
+    lambda: [({"state": state}, pool_stats()[state]) for state in ["sending", "queued"]],
+)
+
+
+def get_loop():
+    """
+    Return the background event loop that runs the sync wrappers.
+
+    The loop runs in a daemon thread, started on first use, so sync
+    callers (e.g. Flask request threads) share its HTTP client and
+    connection pool.
+
+    Returns
+    -------
+    loop : asyncio.AbstractEventLoop
+        The background loop.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="search-loop", daemon=True
+            ).start()
+    return _loop
+
+
+def run_sync(coro):
+    """
+    Run a coroutine on the background loop and wait for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def iterate_sync(agen):
+    """
+    Iterate an async generator from sync code, one item at a time, on the
+    background loop.
+    """
+    try:
+        while True:
+            try:
+                yield run_sync(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(agen.aclose())
+
+
+def quota_day():
+    """
+    Return the day the API quota is counted against, e.g. "2024-05-01".
+
+    The free quota of the Custom Search API resets at midnight Pacific
+    time (API_QUOTA_TIMEZONE), not at midnight UTC.
     """
-    Perform a Google custom search and return the results as a pandas DataFrame.
+    return datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+
+def api_quota_left(storage):
+    """
+    Return the number of API requests left today.
+    """
+    return max(API_DAILY_QUOTA - storage.api_requests(quota_day()), 0)
+
+
+Gauge(
+    "zero_api_quota_remaining",
+    "Search API requests left in today's quota.",
+    [],
+    lambda: [({}, api_quota_left(DBStorage()))],
+)
+
+
+def reserve_api_pages(storage, query, starts, use_reserve=True):
+    """
+    Count the API requests for some result pages against the daily quota.
+
+    The last API_QUOTA_RESERVE requests of the day are kept for the first
+    pages of searches: other fetches (later pages and background
+    refreshes) get no requests once the reserve is reached, and a first
+    page that takes several requests gets only its first one. When the
+    quota is used up, no page is requested and the search falls back to
+    stored results or the local index.
+
+    Parameters
+    ----------
+    storage : DBStorage
+        The storage that counts the requests.
+    query : str
+        The query the pages are for.
+    starts : list
+        The start indexes of the pages that are not cached.
+    use_reserve : bool
+        Whether the fetch may use the reserve.
+
+    Returns
+    -------
+    list
+        The start indexes of the pages that may be requested.
+    """
+    day = quota_day()
+    left = API_DAILY_QUOTA - storage.api_requests(day)
+    if 0 < left <= API_QUOTA_RESERVE:
+        if not use_reserve:
+            logger.warning(
+                "search API quota is low, keeping it for new searches",
+                extra={"query": query, "left": left},
+            )
+            return []
+        if len(starts) > 1:
+            logger.warning(
+                "search API quota is low, requesting fewer pages",
+                extra={"query": query, "left": left},
+            )
+            starts = starts[:1]
+    starts = starts[: max(left, 0)]
+    if starts and storage.reserve_api_requests(day, len(starts), API_DAILY_QUOTA):
+        return starts
+    upstream_errors.inc(kind="quota")
+    logger.warning("search API quota is used up", extra={"query": query})
+    return []
+
+
+def quota_exceeded(response):
+    """
+    Return whether an API response says the daily quota is used up.
+    """
+    if response.status_code == 429:
+        return True
+    return response.status_code == 403 and any(
+        reason in response.text for reason in QUOTA_REASONS
+    )
+
+
+async def async_fetch_api_page(query, start):
+    """
+    Fetch one page of Google custom search results.
+
+    A response saying the daily quota is used up marks it used up in the
+    database too, so no further requests are made today.
+
+    Parameters
+    ----------
+    query : str
+        The query to search for.
+    start : int
+        The 1-based index of the first result on the page.
+
+    Returns
+    -------
+    body : str
+        The JSON text of the response, or None if the request failed or
+        the response is not a valid answer.
+    """
+    url = SEARCH_URL.format(
+        key=SEARCH_KEY, cx=SEARCH_ID, query=quote_plus(query), start=start
+    )
+    try:
+        with stage_seconds.time(stage="api_page"):
+            response = await get_client().get(url)
+            if quota_exceeded(response):
+                await asyncio.to_thread(
+                    DBStorage().exhaust_api_quota, quota_day(), API_DAILY_QUOTA
+                )
+            response.raise_for_status()
+            body = response.text
+            if not isinstance(json.loads(body), dict):
+                raise ValueError("the response is not a JSON object")
+    except (httpx.HTTPError, ValueError) as error:
+        upstream_errors.inc(kind="api")
+        logger.warning(
+            "search API request failed",
+            extra={"query": query, "start": start, "error": repr(error)},
+        )
+        return None
+    return body
+
+
+def page_starts(page):
+    """
+    Return the start indexes of the API requests for a page of results.
+
+    The API returns up to 10 results per request, so a page of
+    RESULT_PAGE_SIZE results takes RESULT_PAGE_SIZE / 10 requests.
+    """
+    first, last = page_ranks(page)
+    return list(range(first, last + 1, 10))
+
+
+async def async_search_api(query, page=1, refresh=False):
+    """
+    Perform a Google custom search and return one page of results as a pandas DataFrame.
+
+    The raw responses are cached per query and start index for
+    API_CACHE_TTL seconds, apart from the scraped pages, so fetching the
+    results again, e.g. after every scrape failed, costs no API request.
+    The missing pages are requested concurrently, within the daily quota
+    (see reserve_api_pages), and merged back in rank order. A page that
+    fails or has no results is skipped, so the DataFrame may hold fewer
+    than RESULT_PAGE_SIZE rows.
 
     Parameters
     ----------
     query : str
         The query to search for.
-    pages : int
-        The number of pages of results to return. Defaults to RESULT_COUNT/10.
+    page : int
+        The page of results to return, from 1.
+    refresh : bool
+        Whether this is a background refresh, which like a page after the
+        first may not use the quota reserve.
 
     Returns
     -------
     res_df : pandas.DataFrame
         A DataFrame with columns "link", "rank", "snippet", and "title".
+        Results are ranked by their position in the whole result list,
+        so the first result on page 2 has rank RESULT_PAGE_SIZE + 1.
+        res_df.attrs["more"] tells whether the API has a next page, as
+        its last response says with queries.nextPage.
     """
-    results = []
-    for i in range(0, pages):
-        start = i * 10 + 1
-        url = SEARCH_URL.format(
-            key=SEARCH_KEY, cx=SEARCH_ID, query=quote_plus(query), start=start
-        )
-        response = requests.get(url)
-        data = response.json()
-        results += data["items"]
+    starts = page_starts(page)
+    storage = DBStorage()
+    with stage_seconds.time(stage="api"):
+        bodies = await asyncio.to_thread(storage.api_responses, query, starts)
+        if bodies:
+            cache_requests.inc(len(bodies), cache="api", result="hit")
+        missing = [start for start in starts if start not in bodies]
+        if missing:
+            cache_requests.inc(len(missing), cache="api", result="miss")
+            use_reserve = page == 1 and not refresh
+            missing = await asyncio.to_thread(
+                reserve_api_pages, storage, query, missing, use_reserve
+            )
+            fetched = await asyncio.gather(
+                *[async_fetch_api_page(query, start) for start in missing]
+            )
+            for start, body in zip(missing, fetched):
+                if body is not None:
+                    bodies[start] = body
+                    await asyncio.to_thread(storage.store_api_response, query, start, body)
+    responses = {start: json.loads(body) for start, body in bodies.items()}
+    results = [
+        item for start in sorted(responses) for item in responses[start].get("items", [])
+    ]
     res_df = pd.DataFrame.from_dict(results)
-    res_df["rank"] = list(range(1, res_df.shape[0] + 1))
-    res_df = res_df[["link", "rank", "snippet", "title"]]
+    res_df = res_df.reindex(columns=["link", "rank", "snippet", "title"])
+    first = page_ranks(page)[0]
+    res_df["rank"] = list(range(first, first + res_df.shape[0]))
+    last = responses.get(starts[-1], {})
+    res_df.attrs["more"] = page < MAX_RESULT_PAGE and bool(
+        last.get("queries", {}).get("nextPage")
+    )
     return res_df
 
 
-def scrape_page(links):
+def search_api(query, page=1):
+    """
+    Sync wrapper of async_search_api.
+    """
+    return run_sync(async_search_api(query, page))
+
+
+def sniff_charset(content_type, head):
+    """
+    Find the character encoding of a page.
+
+    The charset of the Content-Type header wins; otherwise a byte order
+    mark or a <meta> charset declaration in the first bytes of the page
+    is used. Unknown encodings fall back to UTF-8.
+
+    Parameters
+    ----------
+    content_type : str
+        The Content-Type header of the response.
+    head : bytes
+        The first bytes of the body.
+
+    Returns
+    -------
+    str
+        The name of the encoding.
+    """
+    candidates = []
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "charset":
+            candidates.append(value.strip().strip("\"'"))
+    candidates += [name for bom, name in BOMS if head.startswith(bom)]
+    match = META_CHARSET.search(head[:4096])
+    if match:
+        candidates.append(match.group(1).decode("ascii"))
+    for candidate in candidates:
+        try:
+            return codecs.lookup(candidate).name
+        except LookupError:
+            continue
+    return "utf-8"
+
+
+class PageRejected(Exception):
+    """
+    Raised when a page is not downloaded because of the download limits.
+    """
+
+
+async def read_page(response):
+    """
+    Read the body of a page response within the download limits.
+
+    Responses with a Content-Type other than PAGE_CONTENT_TYPES are
+    rejected before their body is read. The body is streamed and cut off
+    after PAGE_MAX_BYTES, so a huge page costs at most that much memory
+    and storage; what was read is still parsed and ranked.
+
+    Parameters
+    ----------
+    response : httpx.Response
+        A streamed response whose body has not been read yet.
+
+    Returns
+    -------
+    str
+        The decoded body.
+
+    Raises
+    ------
+    PageRejected
+        If the page is not HTML.
+    """
+    content_type = response.headers.get("content-type", "")
+    mime = content_type.split(";")[0].strip().lower()
+    if mime and mime not in PAGE_CONTENT_TYPES:
+        page_limits.inc(reason="content_type")
+        raise PageRejected(f"content type {mime}")
+    body = bytearray()
+    async for chunk in response.aiter_bytes():
+        body += chunk
+        if len(body) >= PAGE_MAX_BYTES:
+            page_limits.inc(reason="size")
+            del body[PAGE_MAX_BYTES:]
+            break
+    encoding = sniff_charset(content_type, bytes(body[:4096]))
+    return body.decode(encoding, errors="replace")
+
+
+async def async_download(link, limit=None, validators=None):
+    """
+    Download a page, conditionally if it has been stored before.
+
+    With validators, the request carries If-None-Match and
+    If-Modified-Since headers, and a "304 Not Modified" answer is returned
+    without a body: the stored copy is still current.
+
+    Parameters
+    ----------
+    link : str
+        The URL to fetch.
+    limit : asyncio.Semaphore
+        Optional semaphore bounding the number of concurrent fetches.
+    validators : dict
+        Optional "etag" and "last_modified" of the stored copy, as
+        returned by DBStorage.page_validators.
+
+    Returns
+    -------
+    FetchedPage or None
+        The HTML and validators of the page, or None if the link is not a
+        valid URL, the request failed, the page is not HTML or it took
+        longer than PAGE_DEADLINE seconds.
+    """
+    if limit is not None:
+        async with limit:
+            return await async_download(link, validators=validators)
+
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    async def download():
+        async with get_client().stream("GET", link, headers=headers) as response:
+            etag = response.headers.get("etag")
+            last_modified = response.headers.get("last-modified")
+            if response.status_code == 304 and headers:
+                return response.status_code, FetchedPage(
+                    "",
+                    etag or validators.get("etag"),
+                    last_modified or validators.get("last_modified"),
+                    True,
+                )
+            html = await read_page(response)
+            return response.status_code, FetchedPage(html, etag, last_modified, False)
+
+    host = ""
+    start = time.perf_counter()
+    try:
+        host = httpx.URL(link).host
+        status, page = await asyncio.wait_for(download(), PAGE_DEADLINE)
+    except PageRejected as error:
+        logger.info("page skipped", extra={"link": link, "reason": str(error)})
+        return None
+    except asyncio.TimeoutError:
+        page_limits.inc(reason="deadline")
+        logger.info("page fetch timed out", extra={"link": link})
+        return None
+    except (httpx.HTTPError, httpx.InvalidURL) as error:
+        upstream_errors.inc(kind="page")
+        logger.info("page fetch failed", extra={"link": link, "error": repr(error)})
+        return None
+    finally:
+        fetch_seconds.observe(time.perf_counter() - start, host=host)
+    if headers:
+        result = "not_modified" if page.not_modified else "modified"
+        cache_requests.inc(cache="pages", result=result)
+    logger.debug(
+        "fetched page", extra={"link": link, "status": status, "chars": len(page.html)}
+    )
+    return page
+
+
+async def async_fetch_page(link, limit=None):
+    """
+    Fetch the HTML of a single link.
+
+    Parameters
+    ----------
+    link : str
+        The URL to fetch.
+    limit : asyncio.Semaphore
+        Optional semaphore bounding the number of concurrent fetches.
+
+    Returns
+    -------
+    html : str
+        The HTML of the page, or an empty string if the request failed,
+        the page is not HTML or it took longer than PAGE_DEADLINE seconds.
+    """
+    page = await async_download(link, limit)
+    return page.html if page is not None else ""
+
+
+async def async_download_pages(links, validators=None):
+    """
+    Download a list of pages, conditionally where validators are known.
+
+    At most SCRAPE_WORKERS links are fetched at the same time, so the
+    total time is bounded by the slowest pages rather than the sum of all
+    of them.
+
+    Parameters
+    ----------
+    links : list
+        A list of URLs to download.
+    validators : dict
+        Optional validators of the stored pages, by link.
+
+    Returns
+    -------
+    pages : list
+        A FetchedPage, or None if the download failed, for each link.
+    """
+    validators = validators or {}
+    limit = asyncio.Semaphore(SCRAPE_WORKERS)
+    with stage_seconds.time(stage="scrape"):
+        return list(
+            await asyncio.gather(
+                *[async_download(link, limit, validators.get(link)) for link in links]
+            )
+        )
+
+
+async def async_scrape_page(links):
     """
     Scrape the HTML from a list of links.
 
@@ -53,51 +634,631 @@ def scrape_page(links):
         A list of HTML strings, one for each link. If a link fails to load,
         an empty string will be returned instead.
     """
-    html = []
-    for link in links:
-        print(link)
+    pages = await async_download_pages(links)
+    return [page.html if page is not None else "" for page in pages]
+
+
+def scrape_page(links):
+    """
+    Sync wrapper of async_scrape_page.
+    """
+    return run_sync(async_scrape_page(list(links)))
+
+
+def result_row(query, item, html, created, validators=(None, None), features=None):
+    """
+    Build a row for DBStorage.insert_rows from an API result and its page.
+
+    The ranking features of the page are computed here, once, unless
+    they are given.
+
+    Returns
+    -------
+    list
+        The values of the row, in the order of STORED_COLUMNS.
+    """
+    if features is None:
+        with stage_seconds.time(stage="parse"):
+            features = ranking_features(html)
+    tracker_count, word_count, text = features
+    return [
+        query,
+        int(item["rank"]),
+        item["link"],
+        item["title"],
+        item["snippet"],
+        html,
+        created,
+        tracker_count,
+        word_count,
+        text,
+        *validators,
+    ]
+
+
+def page_row(storage, query, item, page, stored, created):
+    """
+    Build a row for DBStorage.insert_rows from an API result and its download.
+
+    A page that has not been modified since it was stored keeps its
+    stored HTML, text and ranking features; any other page is parsed.
+
+    Parameters
+    ----------
+    storage : DBStorage
+        The storage holding the stored copies of the pages.
+    query : str
+        The query the result is for.
+    item : dict
+        The API result.
+    page : FetchedPage or None
+        The download of the result's page.
+    stored : dict or None
+        The validators and features of the stored copy, as returned by
+        DBStorage.page_validators.
+    created : str
+        The time the results were fetched.
+
+    Returns
+    -------
+    list or None
+        The values of the row, in the order of STORED_COLUMNS, or None if
+        there is no page to store.
+    """
+    if page is None:
+        return None
+    validators = (page.etag, page.last_modified)
+    if page.not_modified and stored is not None:
+        html = storage.page_html(stored["page_hash"])
+        if not html:
+            return None
+        text = storage.page_text(stored["page_hash"])
+        features = (stored["tracker_count"], stored["word_count"], text)
+        return result_row(query, item, html, created, validators, features)
+    if not page.html:
+        return None
+    return result_row(query, item, page.html, created, validators)
+
+
+async def async_fetch_results(query, page=1, refresh=False):
+    """
+    Fetch a page of results for a query from the API and scrape their pages.
+
+    Pages that are already stored with an ETag or Last-Modified value are
+    revalidated with conditional requests, so an unchanged page costs a
+    "304 Not Modified" answer instead of its whole body.
+
+    Parameters
+    ----------
+    query : str
+        The query to search for.
+    page : int
+        The page of results to fetch.
+    refresh : bool
+        Whether this is a background refresh (see async_search_api).
+
+    Returns
+    -------
+    pandas.DataFrame
+        The results that could be scraped, with the columns in
+        STORED_COLUMNS, ready for DBStorage.insert_rows, and the "more"
+        attribute of async_search_api.
+    """
+    results = await async_search_api(query, page, refresh)
+    links = list(results["link"])
+    storage = DBStorage()
+    stored = await asyncio.to_thread(storage.page_validators, links)
+    pages = await async_download_pages(links, stored)
+    created = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+    def build():
+        rows = [
+            page_row(storage, query, item, page, stored.get(item["link"]), created)
+            for item, page in zip(results.to_dict("records"), pages)
+        ]
+        return [row for row in rows if row is not None]
+
+    rows = await asyncio.to_thread(build)
+    fetched = pd.DataFrame(rows, columns=STORED_COLUMNS)
+    fetched.attrs["more"] = results.attrs["more"]
+    return fetched
+
+
+def fetch_results(query, page=1):
+    """
+    Sync wrapper of async_fetch_results.
+    """
+    return run_sync(async_fetch_results(query, page))
+
+
+async def store_results(query, rows, page=1, more=None):
+    """
+    Replace the stored results on a page of a query, then enforce the cache budget.
+
+    The database work runs in a worker thread, off the event loop.
+    """
+
+    def store():
+        storage = DBStorage()
+        with stage_seconds.time(stage="store"):
+            storage.replace_results(query, rows, page, more)
+            storage.evict()
+
+    await asyncio.to_thread(store)
+
+
+async def fetch_and_store(query, page=1, refresh=False):
+    """
+    Fetch a page of results for a query and store them, if there are any.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The fetched results, with the columns in COLUMNS and the "more"
+        attribute of async_search_api.
+    """
+    results = await async_fetch_results(query, page, refresh)
+    more = results.attrs["more"]
+    if results.shape[0] > 0:
+        rows = list(results.itertuples(index=False, name=None))
+        await store_results(query, rows, page, more)
+        logger.info(
+            "stored results",
+            extra={"query": query, "page": page, "count": results.shape[0]},
+        )
+    results = results[COLUMNS]
+    results.attrs["more"] = more
+    return results
+
+
+class FlightAborted(Exception):
+    """
+    Raised to the searches waiting on a fetch whose leader failed.
+    """
+
+
+class Flight:
+    """
+    A fetch of a page of results of a query, led by one search.
+
+    Other searches for the same page of the canonical query in this process wait on
+    the flight's future, on any thread or event loop. Other processes see
+    the flight's lease in the database and wait for it to be released.
+    The leader must end the flight with finish() or abort().
+    """
+
+    def __init__(self, query, future, page=1):
+        self.query = query
+        self.page = page
+        self.key = (canonical_query(query), page)
+        self.future = future
+        self.owner = uuid.uuid4().hex
+
+    def land(self):
+        with _flights_lock:
+            if _flights.get(self.key) is self.future:
+                del _flights[self.key]
+
+    async def release(self):
+        await asyncio.to_thread(
+            DBStorage().release_lease, self.query, self.owner, self.page
+        )
+
+    async def finish(self, results):
+        """
+        Share the results of the fetch with the waiting searches.
+        """
+        self.land()
+        self.future.set_result(results)
+        await self.release()
+
+    async def abort(self):
+        """
+        End the flight without results; the waiting searches fetch again.
+        """
+        self.land()
+        self.future.set_exception(FlightAborted(self.query))
+        await self.release()
+
+
+async def begin_flight(query, page=1):
+    """
+    Join the fetch of a page of a query that is under way, or become its leader.
+
+    Once this search holds the lease, the stored page is looked up again:
+    a fetch that finished, here or in another process, between the
+    caller's lookup and the lease leaves fresh results that are served
+    instead of being fetched a second time.
+
+    Parameters
+    ----------
+    query : str
+        The query to fetch.
+    page : int
+        The page of results to fetch.
+
+    Returns
+    -------
+    tuple
+        (results, None) with the results of a fetch led by another
+        search, or (None, flight) if the caller has to fetch them and end
+        the flight.
+    """
+    key = (canonical_query(query), page)
+    while True:
+        with _flights_lock:
+            future = _flights.get(key)
+            leader = future is None
+            if leader:
+                future = _flights[key] = concurrent.futures.Future()
+        if leader:
+            break
         try:
-            data = requests.get(link, timeout=5)
-            html.append(data.text)
-        except RequestException:
-            html.append("")
-    return html
+            results = await asyncio.wrap_future(future)
+        except FlightAborted:
+            continue
+        coalesced_searches.inc(scope="process")
+        return results.copy(), None
+
+    flight = Flight(query, future, page)
+    try:
+        storage = DBStorage()
+        lease = (query, flight.owner, FLIGHT_LEASE, page)
+        while not await asyncio.to_thread(storage.acquire_lease, *lease):
+            await asyncio.sleep(FLIGHT_POLL)
+        age = await asyncio.to_thread(storage.query_age, query, page)
+        if age is None or age >= CACHE_TTL:
+            return None, flight
+        stored_results, servable = await asyncio.to_thread(
+            stored_or_none, storage, query, page
+        )
+    except BaseException:
+        await flight.abort()
+        raise
+    if not servable:
+        return None, flight
+    coalesced_searches.inc(scope="database")
+    await flight.finish(stored_results)
+    return stored_results.copy(), None
+
+
+async def coalesce(query, fetch, page=1):
+    """
+    Run a fetch of a page of a query once for all concurrent searches for it.
+
+    Searches for the same page of the canonical query that arrive while the fetch is
+    under way, in this process or in another worker process on the same
+    database, wait for it and share its results instead of calling the
+    API and scraping the pages again.
+
+    Parameters
+    ----------
+    query : str
+        The query to fetch.
+    fetch : callable
+        Coroutine function that fetches and stores the results.
+    page : int
+        The page of results to fetch.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The results, with the columns in COLUMNS.
+    """
+    results, flight = await begin_flight(query, page)
+    if flight is None:
+        return results
+    try:
+        results = await fetch()
+    except BaseException:
+        await flight.abort()
+        raise
+    await flight.finish(results)
+    return results
 
 
-def search(query):
+async def async_refresh(query, page=1):
+    """
+    Fetch a page of results for a query again and replace the stored ones.
+
+    If nothing could be fetched, the stored results are kept.
+
+    Parameters
+    ----------
+    query : str
+        The query to refresh.
+    page : int
+        The page of results to refresh.
+
+    Returns
+    -------
+    None
+    """
+    try:
+        await coalesce(query, lambda: fetch_and_store(query, page, True), page)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard((canonical_query(query), page))
+
+
+def refresh_in_background(query, page=1):
+    """
+    Start refreshing a page of a query on the background loop.
+
+    A page that is already being refreshed, in any spelling of the
+    query, is not refreshed twice.
+
+    Parameters
+    ----------
+    query : str
+        The query to refresh.
+    page : int
+        The page of results to refresh.
+
+    Returns
+    -------
+    None
+    """
+    key = (canonical_query(query), page)
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    asyncio.run_coroutine_threadsafe(async_refresh(query, page), get_loop())
+
+
+def stored_or_none(storage, query, page=1):
+    """
+    Look up a page of stored results of a query and decide whether to serve them.
+
+    Stored results younger than CACHE_TTL are served as they are. Older
+    results, up to CACHE_STALE_TTL, are still served, but are refreshed
+    in the background for the next search (stale-while-revalidate). Even
+    older results have to be fetched again.
+
+    Parameters
+    ----------
+    storage : DBStorage
+        The storage to look in.
+    query : str
+        The query to look up.
+    page : int
+        The page of results to look up.
+
+    Returns
+    -------
+    tuple
+        (stored_results, servable): the stored results, possibly empty,
+        and whether they may be served without fetching. The results carry
+        the "more" attribute stored with the page.
+    """
+    with stage_seconds.time(stage="lookup"):
+        stored_results = storage.query_results(query, page)
+        stored_results["created"] = pd.to_datetime(stored_results["created"])
+        age = storage.query_age(query, page) if stored_results.shape[0] > 0 else None
+        more = storage.page_more(query, page) if stored_results.shape[0] > 0 else None
+        stored_results = stored_results[COLUMNS]
+        stored_results.attrs["more"] = more
+    if stored_results.shape[0] > 0:
+        if age is None or age < CACHE_STALE_TTL:
+            if age is not None and age >= CACHE_TTL:
+                cache_requests.inc(cache="results", result="stale")
+                refresh_in_background(query, page)
+            else:
+                cache_requests.inc(cache="results", result="hit")
+            return stored_results, True
+        cache_requests.inc(cache="results", result="expired")
+        logger.info(
+            "stored results expired, using the API",
+            extra={"query": query, "page": page},
+        )
+    else:
+        cache_requests.inc(cache="results", result="miss")
+        logger.info(
+            "no stored results, using the API", extra={"query": query, "page": page}
+        )
+    return stored_results, False
+
+
+def local_page(storage, query, page=1):
+    """
+    Return a page of results for a query from the local full-text index.
+
+    One more match than fits on the page is looked up, to tell whether
+    there is a next page; the results carry that as attrs["more"].
+    """
+    first = page_ranks(page)[0]
+    results = storage.local_results(query, RESULT_PAGE_SIZE + 1, first - 1)
+    more = page < MAX_RESULT_PAGE and results.shape[0] > RESULT_PAGE_SIZE
+    results = results.iloc[:RESULT_PAGE_SIZE]
+    results.attrs.update(local=True, more=more)
+    return results
+
+
+async def async_search(query, mode=SEARCH_MODE, page=1):
     """
     Search for a query in the database or via the Google Custom Search API.
 
+    Only the requested page of results is fetched, so a search costs one
+    page of API requests and scraping, and later pages are fetched and
+    stored when they are asked for.
+
+    With mode "local", the query is answered from the full-text index of
+    every page scraped so far, with no upstream call. With mode "auto",
+    the local index is also used when the API returns nothing, e.g. when
+    the daily quota is exhausted or the machine is offline. Stored
+    results are served as long as stored_or_none allows.
+
     Parameters
     ----------
     query : str
         The search query to look for.
+    mode : str
+        "auto" or "local". Defaults to SEARCH_MODE.
+    page : int
+        The page of results, from 1; a page holds RESULT_PAGE_SIZE results.
 
     Returns
     -------
     pandas.DataFrame
         A DataFrame containing search results with columns: "query", "rank",
-        "link", "title", "snippet", "html", and "created".
+        "link", "title", "snippet", "created", "tracker_count" and
+        "word_count". The ranking features are computed once, when the
+        results are first stored.
         If the query results are found in the database, they are returned directly.
         If not, the function fetches and stores the results using the API.
     """
+    storage = DBStorage()
+    if mode == "local":
+        return await asyncio.to_thread(local_page, storage, query, page)
+
+    stored_results, servable = await asyncio.to_thread(
+        stored_or_none, storage, query, page
+    )
+    if servable:
+        return stored_results
+
+    results = await coalesce(query, lambda: fetch_and_store(query, page), page)
+    if results.shape[0] == 0 and stored_results.shape[0] > 0:
+        return stored_results
+    if results.shape[0] == 0:
+        logger.warning(
+            "no results from the API, using the local index",
+            extra={"query": query, "page": page},
+        )
+        return await asyncio.to_thread(local_page, storage, query, page)
+    return results
+
+
+def search(query, mode=SEARCH_MODE, page=1):
+    """
+    Sync wrapper of async_search.
+    """
+    return run_sync(async_search(query, mode, page))
+
+
+async def async_search_stream(query, mode=SEARCH_MODE, page=1):
+    """
+    Search like async_search(), but yield each result as soon as it is available.
+
+    Stored and local results are yielded at once. Otherwise each page is
+    yielded as soon as it has been scraped and its ranking features
+    computed, in the order the pages arrive; the complete set is stored
+    once the last page is in. Like async_search(), a search for a query
+    that another search is already fetching waits for it instead, and
+    yields its results.
 
-    columns = ["query", "rank", "link", "title", "snippet", "html", "created"]
+    Parameters
+    ----------
+    query : str
+        The search query to look for.
+    mode : str
+        "auto" or "local". Defaults to SEARCH_MODE.
+    page : int
+        The page of results, from 1.
+
+    Yields
+    ------
+    dict
+        One result, with the keys of COLUMNS.
+    """
     storage = DBStorage()
+    if mode == "local":
+        results = await asyncio.to_thread(local_page, storage, query, page)
+        for row in results.to_dict("records"):
+            yield row
+        return
+
+    stored_results, servable = await asyncio.to_thread(
+        stored_or_none, storage, query, page
+    )
+    if servable:
+        for row in stored_results.to_dict("records"):
+            yield row
+        return
+
+    results, flight = await begin_flight(query, page)
+    if flight is None:
+        rows = results.to_dict("records")
+        for row in rows:
+            yield row
+    else:
+        rows = []
+        try:
+            found = await async_search_api(query, page)
+            more = found.attrs["more"]
+            async for row in fetch_rows_as_completed(storage, query, found):
+                rows.append(row)
+                yield {column: row[STORED_COLUMNS.index(column)] for column in COLUMNS}
+            rows.sort(key=lambda row: row[1])
+            if rows:
+                await store_results(query, rows, page, more)
+                logger.info(
+                    "stored results",
+                    extra={"query": query, "page": page, "count": len(rows)},
+                )
+        except BaseException:
+            await flight.abort()
+            raise
+        fetched = pd.DataFrame(rows, columns=STORED_COLUMNS)[COLUMNS]
+        fetched.attrs["more"] = more
+        await flight.finish(fetched)
+    if rows:
+        return
 
-    stored_results = storage.query_results(query)
     if stored_results.shape[0] > 0:
-        stored_results["created"] = pd.to_datetime(stored_results["created"])
-        return stored_results[columns]
-
-    print("No results in database.  Using the API.")
-    results = search_api(query)
-    html = scrape_page(results["link"])
-    results["html"] = html
-    results = results[results["html"].str.len() > 0].copy()
-    results["query"] = query
-    results["created"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    results = results[columns]
-    results.apply(lambda x: storage.insert_row(x), axis=1)
-    print(f"Inserted {results.shape[0]} records.")
-    return results
+        for row in stored_results.to_dict("records"):
+            yield row
+        return
+    logger.warning(
+        "no results from the API, using the local index",
+        extra={"query": query, "page": page},
+    )
+    results = await asyncio.to_thread(local_page, storage, query, page)
+    for row in results.to_dict("records"):
+        yield row
+
+
+async def fetch_rows_as_completed(storage, query, results):
+    """
+    Scrape the pages of API results, yielding each row as its page comes in.
+
+    Parameters
+    ----------
+    storage : DBStorage
+        The storage holding the stored copies of the pages.
+    query : str
+        The query the results are for.
+    results : pandas.DataFrame
+        A page of results, as returned by async_search_api.
+
+    Yields
+    ------
+    list
+        The values of one row, in the order of STORED_COLUMNS.
+    """
+    stored = await asyncio.to_thread(storage.page_validators, list(results["link"]))
+    created = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+    limit = asyncio.Semaphore(SCRAPE_WORKERS)
+
+    async def fetch(item):
+        validators = stored.get(item["link"])
+        page = await async_download(item["link"], limit, validators)
+        return await asyncio.to_thread(
+            page_row, storage, query, item, page, validators, created
+        )
+
+    for task in asyncio.as_completed(
+        [fetch(item) for item in results.to_dict("records")]
+    ):
+        row = await task
+        if row is not None:
+            yield row
+
+
+def search_stream(query, mode=SEARCH_MODE, page=1):
+    """
+    Sync wrapper of async_search_stream.
+    """
+    return iterate_sync(async_search_stream(query, mode, page))
@@ -6,6 +6,43 @@ SEARCH_URL = (
     + COUNTRY
 )
 RESULT_COUNT = 20
+RESULT_PAGE_SIZE = 10
+MAX_RESULT_PAGE = 10
+API_DAILY_QUOTA = 100
+API_QUOTA_RESERVE = 10
+API_QUOTA_TIMEZONE = "America/Los_Angeles"
+SCRAPE_WORKERS = 10
+SCRAPE_TIMEOUT = 5
+HTTP_MAX_CONNECTIONS = 100
+PAGE_MAX_BYTES = 2 * 1024 * 1024
+PAGE_DEADLINE = 10
+PAGE_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+BLACKLIST_PATH = "blacklist.txt"
+BLACKLIST_CACHE = "blacklist.bin"
+DB_PATH = "links.db"
+DB_BUSY_TIMEOUT = 5000
+DB_SCHEMA_TIMEOUT = 600
+DB_SYNCHRONOUS = "NORMAL"
+PAGE_CODEC = "zlib"
+CACHE_TTL = 24 * 60 * 60
+CACHE_STALE_TTL = 7 * 24 * 60 * 60
+API_CACHE_TTL = CACHE_TTL
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_VACUUM_PAGES = 1000
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+RENDER_CACHE_SIZE = 256
+QUERY_TOUCH_INTERVAL = 5 * 60
+QUERY_SORT_TERMS = False
+SEARCH_MODE = "auto"
+FLIGHT_LEASE = 60
+FLIGHT_POLL = 0.1
+FEEDBACK_HALF_LIFE = 30 * 24 * 60 * 60
+FEEDBACK_DOMAIN_WEIGHT = 0.25
+FEEDBACK_WEIGHT = 5
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "json"
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_MAX_SERIES = 200
 
 import os
 
@@ -1,11 +1,369 @@
+import atexit
+import hashlib
+import os
+import time
 import sqlite3
-import pandas as pd
+import threading
+import weakref
+import zlib
+from contextlib import contextmanager
+from lazy import lazy_import
+from filter import ranking_features
+from normalize import canonical_query
+from metrics import Gauge
+from urllib.parse import urlparse
+from settings import *
+
+pd = lazy_import("pandas")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RESULT_COLUMNS = [
+    "id",
+    "query",
+    "query_key",
+    "rank",
+    "link",
+    "title",
+    "snippet",
+    "created",
+    "relevance",
+    "tracker_count",
+    "word_count",
+    "page_hash",
+]
+
+
+FEEDBACK_EPOCH = 1577836800
+
+
+def feedback_decay(age):
+    """
+    Return the factor by which a feedback score decays over age seconds.
+
+    Scores halve every FEEDBACK_HALF_LIFE seconds; a negative age counts
+    as none, so the factor is always between 0 and 1.
+    """
+    return 2 ** (-max(age, 0) / FEEDBACK_HALF_LIFE)
+
+
+def link_domain(link):
+    """
+    Return the domain of a link, without a leading "www.".
+    """
+    try:
+        host = urlparse(link).hostname or ""
+    except ValueError:
+        return ""
+    return host[4:] if host.startswith("www.") else host
+
+
+def content_hash(html):
+    """
+    Return the content address of a page: the SHA-256 of its HTML.
+    """
+    return hashlib.sha256(html.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def page_ranks(page):
+    """
+    Return the first and last rank of the results on a page.
+    """
+    return (page - 1) * RESULT_PAGE_SIZE + 1, page * RESULT_PAGE_SIZE
+
+
+def compress(text, codec=PAGE_CODEC):
+    """
+    Compress a string with the given codec ("zstd" or "zlib").
+
+    Falls back to zlib when zstd is asked for but the zstandard package
+    is not installed.
+
+    Returns
+    -------
+    tuple
+        (codec, data): the codec that was actually used and the bytes.
+    """
+    data = text.encode("utf-8", errors="surrogatepass")
+    if codec == "zstd" and zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor().compress(data)
+    return "zlib", zlib.compress(data)
+
+
+def decompress(data, codec):
+    """
+    Decompress bytes produced by compress back into a string.
+    """
+    if data is None:
+        return ""
+    if codec == "zstd":
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return data.decode("utf-8", errors="surrogatepass")
+
+
+class Connection(sqlite3.Connection):
+    """
+    sqlite3 connection that can be tracked through a weak reference.
+    """
+
+
+class ConnectionManager:
+    """
+    Per-process manager of the SQLite connections to one database file.
+
+    Every thread gets its own connection, opened on first use with WAL
+    journaling, a busy timeout and relaxed fsync settings, so readers and
+    writers in different threads or worker processes do not block each
+    other. A connection is closed when its thread goes away or, at the
+    latest, when the process exits. After a fork the child opens fresh
+    connections instead of reusing the parent's.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.connections = weakref.WeakSet()
+        self.prepared = False
+        self.preparing = False
+
+    def connect(self):
+        """
+        Open and configure a new connection to the database.
+
+        Returns
+        -------
+        con : sqlite3.Connection
+            The new connection.
+        """
+        con = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT / 1000,
+            check_same_thread=False,
+            factory=Connection,
+        )
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        con.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT)}")
+        con.create_function("feedback_decay", 1, feedback_decay, deterministic=True)
+        return con
+
+    def connection(self):
+        """
+        Return the connection of the calling thread, opening it if needed.
+
+        Returns
+        -------
+        con : sqlite3.Connection
+            The connection for this thread.
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = self.connect()
+            self.local.con = con
+            with self.lock:
+                self.connections.add(con)
+        return con
+
+    @contextmanager
+    def schema_lock(self):
+        """
+        Hold the lock that lets one process at a time set up the schema.
+
+        The lock is a write transaction on a side file next to the
+        database (path + "-schema"), so it works wherever SQLite does and
+        is released by the OS if the process dies. Other processes wait
+        for up to DB_SCHEMA_TIMEOUT seconds.
+        """
+        lock = sqlite3.connect(
+            self.path + "-schema", timeout=DB_SCHEMA_TIMEOUT, isolation_level=None
+        )
+        try:
+            lock.execute("BEGIN IMMEDIATE")
+            yield
+        finally:
+            lock.close()
+
+    def prepare(self, setup):
+        """
+        Run the schema setup once per process, and in one process at a time.
+
+        Worker processes that start together on an old database would
+        otherwise run the same migrations at once; under schema_lock the
+        first one migrates and the others find the schema up to date.
+        The setup may itself use the manager's connections; calls made
+        from within it return at once.
+
+        Parameters
+        ----------
+        setup : callable
+            Function that creates and migrates the tables.
+
+        Returns
+        -------
+        None
+        """
+        if self.prepared:
+            return
+        with self.lock:
+            if self.prepared or self.preparing:
+                return
+            self.preparing = True
+            try:
+                with self.schema_lock():
+                    setup()
+                self.prepared = True
+            finally:
+                self.preparing = False
+
+    def reset(self):
+        """
+        Forget the connections inherited from a parent process.
+
+        Returns
+        -------
+        None
+        """
+        with self.lock:
+            self.pid = os.getpid()
+            self.local = threading.local()
+            self.connections = weakref.WeakSet()
+
+    def close(self):
+        """
+        Close every open connection of this process.
+
+        Returns
+        -------
+        None
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            for con in list(self.connections):
+                con.close()
+            self.connections = weakref.WeakSet()
+            self.local = threading.local()
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+_listeners = []
+
+
+def subscribe(callback):
+    """
+    Register a function to call whenever the stored results of a query change.
+
+    Parameters
+    ----------
+    callback : callable
+        Called with the canonical key of the query whose results were
+        inserted, refreshed, marked as relevant or evicted.
+
+    Returns
+    -------
+    callable
+        The callback, so this can be used as a decorator.
+    """
+    _listeners.append(callback)
+    return callback
+
+
+def notify(queries):
+    """
+    Tell every subscriber that the results of the given queries changed.
+
+    The queries are passed as canonical keys.
+    """
+    for query in queries:
+        for callback in _listeners:
+            callback(query)
+
+
+def get_manager(path=DB_PATH):
+    """
+    Return the process-wide connection manager for a database file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database.
+
+    Returns
+    -------
+    ConnectionManager
+        The manager for the database.
+    """
+    with _managers_lock:
+        manager = _managers.get(path)
+        if manager is None:
+            manager = ConnectionManager(path)
+            _managers[path] = manager
+    return manager
+
+
+def connection_counts():
+    """
+    Return the number of open connections per database file.
+    """
+    with _managers_lock:
+        managers = list(_managers.values())
+    return [({"path": m.path}, len(m.connections)) for m in managers]
+
+
+Gauge(
+    "zero_db_connections",
+    "Open SQLite connections of this process, by database file.",
+    ["path"],
+    connection_counts,
+)
+
+
+@atexit.register
+def close_connections():
+    """
+    Close the connections of every manager. Runs at process exit.
+    """
+    with _managers_lock:
+        managers = list(_managers.values())
+    for manager in managers:
+        manager.close()
 
 
 class DBStorage:
-    def __init__(self):
-        self.con = sqlite3.connect("links.db")
-        self.setup_tables()
+    def __init__(self, path=DB_PATH):
+        self.manager = get_manager(path)
+
+    @property
+    def con(self):
+        """
+        The SQLite connection of the calling thread.
+
+        The database is opened, and its tables set up, on first use rather
+        than when the storage is created, so importing the service does
+        not touch the database.
+        """
+        self.prepare()
+        return self.manager.connection()
+
+    def prepare(self):
+        """
+        Set up and migrate the tables now rather than on first use.
+
+        Returns
+        -------
+        None
+        """
+        self.manager.prepare(self.setup_tables)
 
     def setup_tables(self):
         """
@@ -22,10 +380,92 @@ class DBStorage:
             - html TEXT
             - created DATETIME
             - relevance INTEGER
+            - tracker_count INTEGER (added by migration 1)
+            - word_count INTEGER (added by migration 1)
+            - text TEXT (added by migration 1)
+            - page_hash TEXT (added by migration 2)
+            - query_key TEXT (added by migration 4)
             - UNIQUE(query, link)
+            - UNIQUE(query_key, link) (added by migration 4)
+        - pages
+            - hash TEXT PRIMARY KEY
+            - codec TEXT
+            - size INTEGER
+            - body BLOB
+            - text BLOB
+
+        - documents (added by migration 5)
+            - id INTEGER PRIMARY KEY
+            - link TEXT UNIQUE
+            - title TEXT
+            - snippet TEXT
+            - created DATETIME
+            - tracker_count INTEGER
+            - word_count INTEGER
+            - page_hash TEXT
+            - etag TEXT (added by migration 7)
+            - last_modified TEXT (added by migration 7)
+        - corpus (FTS5, added by migration 5)
+            - title, snippet, text; rowid is documents.id
+        - feedback (added by migration 6)
+            - kind TEXT ("link" or "domain")
+            - key TEXT
+            - score REAL
+            - updated REAL (Unix time, added by migration 13)
+            - PRIMARY KEY(kind, key)
+        - api_responses (added by migration 9)
+            - query TEXT (the canonical key)
+            - start INTEGER
+            - codec TEXT
+            - body BLOB
+            - created DATETIME
+            - PRIMARY KEY(query, start)
+        - api_usage (added by migration 9)
+            - day TEXT PRIMARY KEY
+            - requests INTEGER
+        - flights (added by migration 8, keyed by page since migration 10)
+            - query TEXT (the canonical key)
+            - page INTEGER
+            - owner TEXT
+            - expires REAL (Unix time)
+            - PRIMARY KEY(query, page)
+        - result_pages (added by migration 10)
+            - query TEXT (the canonical key)
+            - page INTEGER
+            - created DATETIME
+            - more INTEGER (added by migration 11)
+            - PRIMARY KEY(query, page)
+        - queries (added by migration 3)
+            - query TEXT PRIMARY KEY (the canonical key since migration 4)
+            - created DATETIME
+            - accessed DATETIME
+            - generation INTEGER (added by migration 12)
+
+        Since migration 2, page bodies and their text live in pages, keyed
+        by content hash and compressed; the html and text columns of
+        results are left empty. queries records when the results of each
+        query were fetched and last served, for expiry and eviction, and a
+        generation that every write to them raises. Results
+        are looked up by query_key, the canonical form of the query (see
+        normalize.canonical_query), so spelling variants share one set.
+        documents holds every scraped page once per link, and corpus is
+        the full-text index over it used by local_results, along with the
+        HTTP validators of each page for conditional refetches. feedback
+        aggregates the relevance clicks per link and per domain, each
+        score decayed to the time it was last updated. flights
+        holds a short lease per query and result page that is being
+        fetched, so worker processes fetch it once between them.
+        result_pages records when each page of results of a query was
+        fetched, since the pages are fetched one at a time, as they are
+        asked for, and whether the API has a page after it; a page holds
+        the results ranked RESULT_PAGE_SIZE * (page - 1) + 1 to
+        RESULT_PAGE_SIZE * page. api_responses keeps the
+        raw, compressed Custom Search responses per query and start index,
+        and api_usage counts the API requests per quota day.
 
         """
         cur = self.con.cursor()
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
         results_table = r"""
             CREATE TABLE IF NOT EXISTS results (
                 id INTEGER PRIMARY KEY,
@@ -40,77 +480,1245 @@ class DBStorage:
                 UNIQUE(query, link)
             );
             """
+        pages_table = r"""
+            CREATE TABLE IF NOT EXISTS pages (
+                hash TEXT PRIMARY KEY,
+                codec TEXT,
+                size INTEGER,
+                body BLOB,
+                text BLOB
+            );
+            """
         cur.execute(results_table)
+        cur.execute(pages_table)
         self.con.commit()
         cur.close()
+        self.migrate()
 
-    def query_results(self, query):
+    def migrate(self):
         """
-        Query the database for results for a given query, and return as a DataFrame sorted by rank.
+        Bring an existing database up to the current schema.
 
-        Parameters
-        ----------
-        query : str
-            The query to search for.
+        The schema version is kept in PRAGMA user_version, and every
+        migration with a higher number than the stored version is applied
+        in order. It runs under ConnectionManager.schema_lock, so the
+        version read here includes the migrations of any other process.
+
+        Migrations:
+        - 1: add the precomputed ranking features (tracker_count,
+          word_count, text) to results and backfill them from the stored
+          HTML.
+        - 2: move page HTML and text out of results into the compressed,
+          content-addressed pages table.
+        - 3: add the queries table and switch the file to incremental
+          auto-vacuum, so evicted space can be returned step by step.
+        - 4: add the canonical query_key to results, merge results whose
+          queries share a key, and re-key the queries table.
+        - 5: add the documents table and the corpus full-text index, and
+          index every stored page.
+        - 6: add the feedback table and seed it with the stored relevance
+          marks.
+        - 7: add the ETag and Last-Modified validators to documents.
+        - 8: add the flights table of fetch leases.
+        - 9: add the api_responses cache and the api_usage quota counter.
+        - 10: add result_pages, filled from the stored results, and key the
+          flights by page.
+        - 11: add the "more" flag to result_pages.
+        - 12: add the generation counter to queries.
+        - 13: add the update time to feedback, and decay the scores,
+          which were scaled to FEEDBACK_EPOCH, to it.
 
         Returns
         -------
-        df : pandas.DataFrame
-            The results of the query, sorted by rank.
+        None
         """
-        df = pd.read_sql(
-            "select * from results where query=? order by rank asc",
-            self.con,
-            params=[query],
-        )
-        return df
+        version = self.con.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self.add_feature_columns()
+            self.con.execute("PRAGMA user_version = 1")
+            self.con.commit()
+        if version < 2:
+            self.move_pages()
+            self.con.execute("PRAGMA user_version = 2")
+            self.con.commit()
+            self.con.execute("VACUUM")
+        if version < 3:
+            self.add_queries_table()
+            self.con.execute("PRAGMA user_version = 3")
+            self.con.commit()
+            if self.con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self.con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                self.con.execute("VACUUM")
+        if version < 4:
+            self.add_query_keys()
+            self.con.execute("PRAGMA user_version = 4")
+            self.con.commit()
+        if version < 5:
+            self.add_corpus()
+            self.con.execute("PRAGMA user_version = 5")
+            self.con.commit()
+        if version < 6:
+            self.add_feedback_table()
+            self.con.execute("PRAGMA user_version = 6")
+            self.con.commit()
+        if version < 7:
+            self.add_column("documents", "etag", "TEXT")
+            self.add_column("documents", "last_modified", "TEXT")
+            self.con.execute("PRAGMA user_version = 7")
+            self.con.commit()
+        if version < 8:
+            self.con.execute(
+                r"""
+                CREATE TABLE IF NOT EXISTS flights (
+                    query TEXT PRIMARY KEY,
+                    owner TEXT,
+                    expires REAL
+                ) WITHOUT ROWID;
+                """
+            )
+            self.con.execute("PRAGMA user_version = 8")
+            self.con.commit()
+        if version < 9:
+            self.add_api_tables()
+            self.con.execute("PRAGMA user_version = 9")
+            self.con.commit()
+        if version < 10:
+            self.add_result_pages()
+            self.con.execute("PRAGMA user_version = 10")
+            self.con.commit()
+        if version < 11:
+            self.add_column("result_pages", "more", "INTEGER")
+            self.con.execute("PRAGMA user_version = 11")
+            self.con.commit()
+        if version < 12:
+            self.add_column("queries", "generation", "INTEGER DEFAULT 0")
+            self.con.execute("PRAGMA user_version = 12")
+            self.con.commit()
+        if version < 13:
+            self.add_column("feedback", "updated", "REAL")
+            now = time.time()
+            self.con.execute(
+                "UPDATE feedback SET score=score * feedback_decay(?), updated=? WHERE updated IS NULL",
+                [now - FEEDBACK_EPOCH, now],
+            )
+            self.con.execute("PRAGMA user_version = 13")
+            self.con.commit()
 
-    def insert_row(self, values):
+    def add_column(self, table, column, kind):
         """
-        Insert a row into the database with the given values.
+        Add a column to a table unless it is already there.
 
-        Parameters
-        ----------
-        values : list
-            A list of values for the row to be inserted, in the order of:
-            [query, rank, link, title, snippet, html, created]
+        Returns
+        -------
+        None
+        """
+        columns = [row[1] for row in self.con.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            self.con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+
+    def add_feature_columns(self):
+        """
+        Add the ranking feature columns to results and backfill them.
 
         Returns
         -------
         None
         """
+        for column, kind in [
+            ("tracker_count", "INTEGER"),
+            ("word_count", "INTEGER"),
+            ("text", "TEXT"),
+        ]:
+            self.add_column("results", column, kind)
         cur = self.con.cursor()
-        try:
-            cur.execute(
-                "INSERT INTO results (query, rank, link, title, snippet, html, created) VALUES(?, ?, ?, ?, ?, ?, ?)",
-                values,
-            )
-            self.con.commit()
-        except sqlite3.IntegrityError:
-            pass
+        rows = cur.execute(
+            "SELECT id, html FROM results WHERE word_count IS NULL"
+        ).fetchall()
+        cur.executemany(
+            "UPDATE results SET tracker_count=?, word_count=?, text=? WHERE id=?",
+            [(*ranking_features(html), id) for id, html in rows],
+        )
+        self.con.commit()
         cur.close()
 
-    def update_relevance(self, query, link, relevance):
+    def add_queries_table(self):
         """
-        Update the relevance of a search result in the database.
+        Create the queries table and fill it from the stored results.
+
+        Returns
+        -------
+        None
+        """
+        self.con.execute(
+            r"""
+            CREATE TABLE IF NOT EXISTS queries (
+                query TEXT PRIMARY KEY,
+                created DATETIME,
+                accessed DATETIME
+            );
+            """
+        )
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS queries_accessed ON queries(accessed)"
+        )
+        self.con.execute(
+            """
+            INSERT OR IGNORE INTO queries (query, created, accessed)
+            SELECT query, MAX(created), MAX(created) FROM results GROUP BY query
+            """
+        )
+
+    def add_query_keys(self):
+        """
+        Add the canonical query_key to results and re-key the queries table.
+
+        Rows of different queries that share a key and a link are merged
+        into the most recent one, keeping the highest relevance.
+
+        Returns
+        -------
+        None
+        """
+        self.add_column("results", "query_key", "TEXT")
+        queries = [row[0] for row in self.con.execute("SELECT DISTINCT query FROM results")]
+        self.con.executemany(
+            "UPDATE results SET query_key=? WHERE query=?",
+            [(canonical_query(query), query) for query in queries],
+        )
+        self.con.execute(
+            """
+            UPDATE results SET relevance=(
+                SELECT MAX(r.relevance) FROM results r
+                WHERE r.query_key=results.query_key AND r.link=results.link
+            )
+            """
+        )
+        self.con.execute(
+            """
+            DELETE FROM results WHERE id NOT IN (
+                SELECT MAX(id) FROM results GROUP BY query_key, link
+            )
+            """
+        )
+        self.con.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS results_query_key_link ON results(query_key, link)"
+        )
+        self.con.execute("DELETE FROM queries")
+        self.con.execute(
+            """
+            INSERT INTO queries (query, created, accessed)
+            SELECT query_key, MAX(created), MAX(created) FROM results GROUP BY query_key
+            """
+        )
+
+    def add_feedback_table(self):
+        """
+        Create the feedback table and record the stored relevance marks in it.
+
+        Returns
+        -------
+        None
+        """
+        self.con.execute(
+            r"""
+            CREATE TABLE IF NOT EXISTS feedback (
+                kind TEXT,
+                key TEXT,
+                score REAL,
+                updated REAL,
+                PRIMARY KEY(kind, key)
+            ) WITHOUT ROWID;
+            """
+        )
+        rows = self.con.execute(
+            """
+            SELECT link, CAST(strftime('%s', created) AS REAL) FROM results
+            WHERE relevance > 0
+            """
+        ).fetchall()
+        for link, at in rows:
+            self.record_feedback(link, at=at)
+
+    def add_api_tables(self):
+        """
+        Create the tables of raw API responses and API usage.
+
+        Returns
+        -------
+        None
+        """
+        self.con.execute(
+            r"""
+            CREATE TABLE IF NOT EXISTS api_responses (
+                query TEXT,
+                start INTEGER,
+                codec TEXT,
+                body BLOB,
+                created DATETIME,
+                PRIMARY KEY(query, start)
+            ) WITHOUT ROWID;
+            """
+        )
+        self.con.execute(
+            r"""
+            CREATE TABLE IF NOT EXISTS api_usage (
+                day TEXT PRIMARY KEY,
+                requests INTEGER
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def add_result_pages(self):
+        """
+        Create the result_pages table and re-create flights keyed by page.
+
+        Every page that holds stored results is recorded as fetched when
+        its oldest result was. The leases in flights are short-lived, so
+        the table is dropped rather than migrated.
+
+        Returns
+        -------
+        None
+        """
+        self.con.execute(
+            r"""
+            CREATE TABLE IF NOT EXISTS result_pages (
+                query TEXT,
+                page INTEGER,
+                created DATETIME,
+                PRIMARY KEY(query, page)
+            ) WITHOUT ROWID;
+            """
+        )
+        self.con.execute(
+            """
+            INSERT OR IGNORE INTO result_pages (query, page, created)
+            SELECT query_key, (rank - 1) / ? + 1, MIN(created) FROM results
+            WHERE query_key IS NOT NULL GROUP BY 1, 2
+            """,
+            [RESULT_PAGE_SIZE],
+        )
+        self.con.execute("DROP TABLE IF EXISTS flights")
+        self.con.execute(
+            r"""
+            CREATE TABLE flights (
+                query TEXT,
+                page INTEGER,
+                owner TEXT,
+                expires REAL,
+                PRIMARY KEY(query, page)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def add_corpus(self, batch=200):
+        """
+        Create the documents table and its full-text index, and index the
+        pages that are already stored.
 
         Parameters
         ----------
-        query : str
-            The query the result is for.
-        link : str
-            The link of the result.
-        relevance : int
-            The new relevance value.
+        batch : int
+            The number of pages indexed per step.
 
         Returns
         -------
         None
         """
-        cur = self.con.cursor()
-        cur.execute(
-            "UPDATE results SET relevance=? WHERE query=? AND link=?",
-            [relevance, query, link],
+        self.con.execute(
+            r"""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                link TEXT UNIQUE,
+                title TEXT,
+                snippet TEXT,
+                created DATETIME,
+                tracker_count INTEGER,
+                word_count INTEGER,
+                page_hash TEXT
+            );
+            """
+        )
+        self.con.execute(
+            r"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS corpus USING fts5(
+                title, snippet, text, tokenize='unicode61 remove_diacritics 2'
+            );
+            """
+        )
+        rows = self.con.execute(
+            """
+            SELECT link, title, snippet, MAX(created), tracker_count, word_count, page_hash
+            FROM results WHERE page_hash IS NOT NULL GROUP BY link
+            """
+        ).fetchall()
+        for i in range(0, len(rows), batch):
+            documents = [
+                list(row[:6]) + [self.page_text(row[6]), row[6]]
+                for row in rows[i : i + batch]
+            ]
+            self.index_documents(documents)
+            self.con.commit()
+
+    def index_documents(self, documents):
+        """
+        Add pages to the full-text index, or update them.
+
+        A page whose link is indexed with the same content is left alone.
+        The caller is responsible for committing.
+
+        Parameters
+        ----------
+        documents : list
+            Rows of [link, title, snippet, created, tracker_count,
+            word_count, text, page_hash].
+
+        Returns
+        -------
+        None
+        """
+        for link, title, snippet, created, trackers, words, text, page_hash in documents:
+            row = self.con.execute(
+                "SELECT id, page_hash, title, snippet FROM documents WHERE link=?", [link]
+            ).fetchone()
+            if row is not None and row[1:] == (page_hash, title, snippet):
+                continue
+            if row is None:
+                id = self.con.execute(
+                    "INSERT INTO documents (link) VALUES(?)", [link]
+                ).lastrowid
+            else:
+                id = row[0]
+                self.con.execute("DELETE FROM corpus WHERE rowid=?", [id])
+            self.con.execute(
+                """
+                UPDATE documents SET title=?, snippet=?, created=?, tracker_count=?,
+                    word_count=?, page_hash=?
+                WHERE id=?
+                """,
+                [title, snippet, created, trackers, words, page_hash, id],
+            )
+            self.con.execute(
+                "INSERT INTO corpus (rowid, title, snippet, text) VALUES(?, ?, ?, ?)",
+                [id, title, snippet, text],
+            )
+
+    def local_results(self, query, limit=RESULT_COUNT, offset=0):
+        """
+        Answer a query from the local full-text index, without the API.
+
+        Every page ever scraped is searched, and matches are ranked with
+        BM25, weighting title over snippet over page text.
+
+        Parameters
+        ----------
+        query : str
+            The query to search for.
+        limit : int
+            The maximum number of results.
+        offset : int
+            The number of best matches to skip, for the later pages.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            The best matches, with the same columns as search() returns,
+            ranked from offset + 1. df.attrs["local"] is set, so callers can tell
+            these results from stored API results.
+        """
+        terms = canonical_query(query, sort_terms=False).split()
+        match = " OR ".join('"' + t.replace('"', '""') + '"' for t in terms)
+        columns = [
+            "query",
+            "rank",
+            "link",
+            "title",
+            "snippet",
+            "created",
+            "tracker_count",
+            "word_count",
+        ]
+        if not match:
+            df = pd.DataFrame(columns=columns)
+            df.attrs["local"] = True
+            return df
+        df = pd.read_sql(
+            """
+            SELECT d.link, d.title, d.snippet, d.created, d.tracker_count, d.word_count
+            FROM corpus JOIN documents d ON d.id = corpus.rowid
+            WHERE corpus MATCH ?
+            ORDER BY bm25(corpus, 10.0, 5.0, 1.0)
+            LIMIT ? OFFSET ?
+            """,
+            self.con,
+            params=[match, limit, offset],
+        )
+        df["query"] = query
+        df["rank"] = list(range(offset + 1, offset + df.shape[0] + 1))
+        df = df[columns]
+        df.attrs["local"] = True
+        return df
+
+    def move_pages(self, batch=200):
+        """
+        Move the HTML and text stored inline in results into pages.
+
+        Parameters
+        ----------
+        batch : int
+            The number of rows moved per step.
+
+        Returns
+        -------
+        None
+        """
+        self.add_column("results", "page_hash", "TEXT")
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS results_page_hash ON results(page_hash)"
+        )
+        ids = [
+            row[0]
+            for row in self.con.execute(
+                "SELECT id FROM results WHERE html IS NOT NULL AND page_hash IS NULL"
+            )
+        ]
+        for i in range(0, len(ids), batch):
+            chunk = ids[i : i + batch]
+            marks = ", ".join("?" * len(chunk))
+            rows = self.con.execute(
+                f"SELECT id, html, text FROM results WHERE id IN ({marks})", chunk
+            ).fetchall()
+            hashes = self.store_pages([(html, text) for _, html, text in rows])
+            self.con.executemany(
+                "UPDATE results SET page_hash=?, html=NULL, text=NULL WHERE id=?",
+                [(h, id) for h, (id, _, _) in zip(hashes, rows)],
+            )
+            self.con.commit()
+
+    def store_pages(self, pages):
+        """
+        Store page bodies in the pages table, once per distinct content.
+
+        Only pages that are not stored yet are compressed and written. The
+        caller is responsible for committing.
+
+        Parameters
+        ----------
+        pages : list
+            (html, text) pairs.
+
+        Returns
+        -------
+        hashes : list
+            The content hash of each page, in the same order.
+        """
+        hashes = [content_hash(html or "") for html, _ in pages]
+        unique = list(dict.fromkeys(hashes))
+        marks = ", ".join("?" * len(unique))
+        stored = {
+            row[0]
+            for row in self.con.execute(
+                f"SELECT hash FROM pages WHERE hash IN ({marks})", unique
+            )
+        }
+        new_pages = {}
+        for h, (html, text) in zip(hashes, pages):
+            if h in stored or h in new_pages:
+                continue
+            codec, body = compress(html or "")
+            text = compress(text or "", codec)[1]
+            new_pages[h] = (h, codec, len(html or ""), body, text)
+        self.con.executemany(
+            "INSERT OR IGNORE INTO pages (hash, codec, size, body, text) VALUES(?, ?, ?, ?, ?)",
+            list(new_pages.values()),
+        )
+        return hashes
+
+    def page_validators(self, links):
+        """
+        Return the stored HTTP validators of pages, for conditional requests.
+
+        Only pages that have an ETag or Last-Modified value and whose body
+        is still stored are returned, since a "304 Not Modified" answer is
+        only useful if the stored copy can be served instead.
+
+        Parameters
+        ----------
+        links : list
+            The links of the pages.
+
+        Returns
+        -------
+        dict
+            For each link with validators, a dict with the keys "etag",
+            "last_modified", "page_hash", "tracker_count" and "word_count".
+        """
+        links = list(dict.fromkeys(links))
+        if not links:
+            return {}
+        marks = ", ".join("?" * len(links))
+        rows = self.con.execute(
+            f"""
+            SELECT d.link, d.etag, d.last_modified, d.page_hash, d.tracker_count, d.word_count
+            FROM documents d JOIN pages p ON p.hash = d.page_hash
+            WHERE d.link IN ({marks})
+                AND (d.etag IS NOT NULL OR d.last_modified IS NOT NULL)
+            """,
+            links,
+        ).fetchall()
+        keys = ["etag", "last_modified", "page_hash", "tracker_count", "word_count"]
+        return {row[0]: dict(zip(keys, row[1:])) for row in rows}
+
+    def page_html(self, page_hash):
+        """
+        Return the HTML of a stored page, decompressing it on demand.
+
+        Parameters
+        ----------
+        page_hash : str
+            The content hash of the page, as in the page_hash column.
+
+        Returns
+        -------
+        str
+            The HTML, or an empty string if the page is not stored.
+        """
+        row = self.con.execute(
+            "SELECT body, codec FROM pages WHERE hash=?", [page_hash]
+        ).fetchone()
+        return decompress(*row) if row else ""
+
+    def page_text(self, page_hash):
+        """
+        Return the extracted text of a stored page, decompressing it on demand.
+
+        Parameters
+        ----------
+        page_hash : str
+            The content hash of the page, as in the page_hash column.
+
+        Returns
+        -------
+        str
+            The text, or an empty string if the page is not stored.
+        """
+        row = self.con.execute(
+            "SELECT text, codec FROM pages WHERE hash=?", [page_hash]
+        ).fetchone()
+        return decompress(*row) if row else ""
+
+    def query_results(self, query, page=None):
+        """
+        Query the database for results for a given query, and return as a DataFrame sorted by rank.
+
+        Results are matched on the canonical key of the query, so any
+        spelling variant of a stored query is a hit.
+
+        The stored HTML and page text are not loaded; the results carry the
+        precomputed ranking features instead, and a page_hash that
+        page_html and page_text accept.
+
+        Parameters
+        ----------
+        query : str
+            The query to search for.
+        page : int
+            The page of results to return, or None for all stored results.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            The results of the query, sorted by rank.
+        """
+        first, last = page_ranks(page) if page else (1, 2**62)
+        df = pd.read_sql(
+            f"select {', '.join(RESULT_COLUMNS)} from results where query_key=? and rank between ? and ? order by rank asc",
+            self.con,
+            params=[canonical_query(query), first, last],
+        )
+        if df.shape[0] > 0:
+            with self.con:
+                self.con.execute(
+                    "UPDATE queries SET accessed=datetime('now') WHERE query=?",
+                    [canonical_query(query)],
+                )
+        return df
+
+    def query_age(self, query, page=1):
+        """
+        Return how long ago a page of results for a query was fetched.
+
+        Parameters
+        ----------
+        query : str
+            The query to look up.
+        page : int
+            The page of results.
+
+        Returns
+        -------
+        float or None
+            The age in seconds, or None if the page is not stored.
+        """
+        row = self.con.execute(
+            "SELECT (julianday('now') - julianday(created)) * 86400 FROM result_pages WHERE query=? AND page=?",
+            [canonical_query(query), page],
+        ).fetchone()
+        return row[0] if row else None
+
+    def page_more(self, query, page=1):
+        """
+        Return whether the API has a page of results after a stored page.
+
+        Returns
+        -------
+        bool or None
+            None if the page is not stored, or was stored without knowing.
+        """
+        row = self.con.execute(
+            "SELECT more FROM result_pages WHERE query=? AND page=?",
+            [canonical_query(query), page],
+        ).fetchone()
+        return None if row is None or row[0] is None else bool(row[0])
+
+    def page_version(self, query, page=1):
+        """
+        Return the generation of the stored results of a query, if a page
+        of them is stored and still fresh.
+
+        The generation is raised by every write to the results of the
+        query, from any process, so a cached rendering of the page is
+        current as long as the generation it was made from is.
+
+        Since a cached rendering is served without query_results, the
+        query is marked as accessed here too, so eviction does not take
+        the most served queries for unused ones. To keep lookups
+        read-only, it is only written once it is QUERY_TOUCH_INTERVAL old.
+
+        Parameters
+        ----------
+        query : str
+            The query to look up.
+        page : int
+            The page of results.
+
+        Returns
+        -------
+        int or None
+            The generation, or None if the page is not stored or is
+            older than CACHE_TTL.
+        """
+        row = self.con.execute(
+            """
+            SELECT q.generation,
+                (julianday('now') - julianday(p.created)) * 86400,
+                (julianday('now') - julianday(q.accessed)) * 86400
+            FROM result_pages p JOIN queries q ON q.query = p.query
+            WHERE p.query=? AND p.page=?
+            """,
+            [canonical_query(query), page],
+        ).fetchone()
+        if row is None or row[1] > CACHE_TTL:
+            return None
+        generation, _, accessed = row
+        if accessed is None or accessed > QUERY_TOUCH_INTERVAL:
+            with self.con:
+                self.con.execute(
+                    "UPDATE queries SET accessed=datetime('now') WHERE query=?",
+                    [canonical_query(query)],
+                )
+        return generation or 0
+
+    def replace_results(self, query, rows, page=1, more=None):
+        """
+        Replace the stored results on one page of a query with a freshly fetched set.
+
+        Links on the page that are no longer in the results are removed;
+        links that are still there keep their relevance. The results on
+        the other pages are left as they are.
+
+        Parameters
+        ----------
+        query : str
+            The query the results are for.
+        rows : iterable
+            Rows of values, each in the order of insert_row.
+        page : int
+            The page the results are on.
+        more : bool
+            Whether the API has a page of results after this one, or None
+            if that is not known.
+
+        Returns
+        -------
+        None
+        """
+        rows = [list(values) for values in rows]
+        links = [row[2] for row in rows]
+        marks = ", ".join("?" * len(links))
+        with self.con:
+            self.con.execute(
+                f"DELETE FROM results WHERE query_key=? AND rank BETWEEN ? AND ? AND link NOT IN ({marks})",
+                [canonical_query(query), *page_ranks(page)] + links,
+            )
+            self.con.execute(
+                """
+                INSERT OR REPLACE INTO result_pages (query, page, created, more)
+                VALUES(?, ?, datetime('now'), ?)
+                """,
+                [canonical_query(query), page, more],
+            )
+            self.insert_rows(rows)
+
+    def size(self):
+        """
+        Return the number of bytes of the database file that are in use.
+
+        Returns
+        -------
+        int
+            The used size in bytes, not counting free pages.
+        """
+        page_size = self.con.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.con.execute("PRAGMA page_count").fetchone()[0]
+        free_count = self.con.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free_count) * page_size
+
+    def evict(self, max_bytes=CACHE_MAX_BYTES, batch=10):
+        """
+        Drop the least recently used queries until the database fits its budget.
+
+        Queries are removed in order of last access, a batch at a time,
+        together with the pages (and their full-text index entries) no
+        other query references. Afterwards an
+        incremental vacuum hands up to CACHE_VACUUM_PAGES free pages back
+        to the file system, so the file shrinks a step at a time instead
+        of with one long VACUUM.
+
+        Parameters
+        ----------
+        max_bytes : int
+            The budget for the used size of the database.
+        batch : int
+            The number of queries removed per step.
+
+        Returns
+        -------
+        evicted : int
+            The number of queries removed.
+        """
+        evicted = 0
+        while self.size() > max_bytes:
+            queries = [
+                row[0]
+                for row in self.con.execute(
+                    "SELECT query FROM queries ORDER BY accessed ASC LIMIT ?", [batch]
+                )
+            ]
+            if not queries:
+                break
+            marks = ", ".join("?" * len(queries))
+            with self.con:
+                self.con.execute(
+                    f"DELETE FROM results WHERE query_key IN ({marks})", queries
+                )
+                self.con.execute(f"DELETE FROM queries WHERE query IN ({marks})", queries)
+                self.con.execute(
+                    f"DELETE FROM api_responses WHERE query IN ({marks})", queries
+                )
+                self.con.execute(
+                    f"DELETE FROM result_pages WHERE query IN ({marks})", queries
+                )
+                self.con.execute(
+                    "DELETE FROM corpus WHERE rowid IN (SELECT id FROM documents WHERE link NOT IN (SELECT link FROM results))"
+                )
+                self.con.execute(
+                    "DELETE FROM documents WHERE link NOT IN (SELECT link FROM results)"
+                )
+                self.con.execute(
+                    "DELETE FROM pages WHERE hash NOT IN (SELECT page_hash FROM results WHERE page_hash IS NOT NULL)"
+                )
+            evicted += len(queries)
+            notify(queries)
+        if evicted:
+            self.con.execute(f"PRAGMA incremental_vacuum({int(CACHE_VACUUM_PAGES)})")
+            self.con.commit()
+        return evicted
+
+    def insert_row(self, values):
+        """
+        Insert a row into the database with the given values.
+
+        Parameters
+        ----------
+        values : list
+            A list of values for the row to be inserted, in the order of:
+            [query, rank, link, title, snippet, html, created,
+            tracker_count, word_count, text], optionally followed by the
+            etag and last_modified validators of the page.
+
+        Returns
+        -------
+        None
+        """
+        self.insert_rows([values])
+
+    def insert_rows(self, rows):
+        """
+        Insert or update a set of rows in a single transaction.
+
+        A row whose link is already stored for the same canonical query
+        replaces the stored values, but keeps its relevance. The HTML and
+        text of each row are stored in pages and referenced by their
+        content hash, and every page is added to the full-text index
+        together with its HTTP validators, if the row has them.
+
+        Parameters
+        ----------
+        rows : iterable
+            Rows of values, each in the order of insert_row.
+
+        Returns
+        -------
+        None
+        """
+        rows = [list(values) for values in rows]
+        if not rows:
+            return
+        keys = [canonical_query(row[0]) for row in rows]
+        with self.con:
+            hashes = self.store_pages([(row[5], row[9]) for row in rows])
+            self.con.executemany(
+                """
+                INSERT INTO results (query, rank, link, title, snippet, created, tracker_count, word_count, page_hash, query_key)
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(query_key, link) DO UPDATE SET
+                    rank=excluded.rank,
+                    title=excluded.title,
+                    snippet=excluded.snippet,
+                    created=excluded.created,
+                    tracker_count=excluded.tracker_count,
+                    word_count=excluded.word_count,
+                    page_hash=excluded.page_hash
+                """,
+                [
+                    row[:5] + row[6:9] + [h, key]
+                    for row, h, key in zip(rows, hashes, keys)
+                ],
+            )
+            self.con.executemany(
+                """
+                INSERT INTO queries (query, created, accessed, generation)
+                VALUES(?, datetime('now'), datetime('now'), 1)
+                ON CONFLICT(query) DO UPDATE SET
+                    created=excluded.created,
+                    accessed=excluded.accessed,
+                    generation=queries.generation + 1
+                """,
+                [[key] for key in dict.fromkeys(keys)],
+            )
+            self.index_documents(
+                [row[2:5] + row[6:10] + [h] for row, h in zip(rows, hashes)]
+            )
+            self.con.executemany(
+                "UPDATE documents SET etag=?, last_modified=? WHERE link=?",
+                [(row + [None, None])[10:12] + [row[2]] for row in rows],
+            )
+        notify(dict.fromkeys(keys))
+
+    def api_responses(self, query, starts, max_age=API_CACHE_TTL):
+        """
+        Return the cached raw API responses of a query.
+
+        Parameters
+        ----------
+        query : str
+            The query the responses are for.
+        starts : list
+            The start indexes of the result pages.
+        max_age : float
+            The age in seconds beyond which a response is not returned.
+
+        Returns
+        -------
+        dict
+            The JSON text of each cached response, by start index.
+        """
+        starts = list(starts)
+        if not starts:
+            return {}
+        marks = ", ".join("?" * len(starts))
+        rows = self.con.execute(
+            f"""
+            SELECT start, body, codec FROM api_responses
+            WHERE query=? AND start IN ({marks})
+                AND (julianday('now') - julianday(created)) * 86400 < ?
+            """,
+            [canonical_query(query)] + starts + [max_age],
+        ).fetchall()
+        return {start: decompress(body, codec) for start, body, codec in rows}
+
+    def store_api_response(self, query, start, body):
+        """
+        Cache the raw API response for one page of the results of a query.
+
+        Responses older than API_CACHE_TTL are dropped on the way.
+
+        Parameters
+        ----------
+        query : str
+            The query the response is for.
+        start : int
+            The start index of the result page.
+        body : str
+            The JSON text of the response.
+
+        Returns
+        -------
+        None
+        """
+        codec, data = compress(body)
+        with self.con:
+            self.con.execute(
+                "DELETE FROM api_responses WHERE created < datetime('now', ?)",
+                [f"-{int(API_CACHE_TTL)} seconds"],
+            )
+            self.con.execute(
+                """
+                INSERT OR REPLACE INTO api_responses (query, start, codec, body, created)
+                VALUES(?, ?, ?, ?, datetime('now'))
+                """,
+                [canonical_query(query), start, codec, data],
+            )
+
+    def api_requests(self, day):
+        """
+        Return the number of API requests counted on a quota day.
+        """
+        row = self.con.execute(
+            "SELECT requests FROM api_usage WHERE day=?", [day]
+        ).fetchone()
+        return row[0] if row else 0
+
+    def reserve_api_requests(self, day, count, limit):
+        """
+        Count API requests against the daily quota, if it allows them.
+
+        The check and the update are one statement, so concurrent workers
+        cannot overspend the quota between them.
+
+        Parameters
+        ----------
+        day : str
+            The quota day.
+        count : int
+            The number of requests about to be made.
+        limit : int
+            The number of requests allowed per day.
+
+        Returns
+        -------
+        bool
+            Whether the requests were counted and may be made.
+        """
+        if count > limit:
+            return False
+        with self.con:
+            cur = self.con.execute(
+                """
+                INSERT INTO api_usage (day, requests) VALUES(?, ?)
+                ON CONFLICT(day) DO UPDATE SET requests=requests + excluded.requests
+                WHERE requests + excluded.requests <= ?
+                """,
+                [day, count, limit],
+            )
+        return cur.rowcount == 1
+
+    def exhaust_api_quota(self, day, limit):
+        """
+        Record that the quota of a day is used up, e.g. after the API said so.
+
+        Returns
+        -------
+        None
+        """
+        with self.con:
+            self.con.execute(
+                """
+                INSERT INTO api_usage (day, requests) VALUES(?, ?)
+                ON CONFLICT(day) DO UPDATE SET requests=MAX(requests, excluded.requests)
+                """,
+                [day, limit],
+            )
+
+    def acquire_lease(self, query, owner, ttl=FLIGHT_LEASE, page=1):
+        """
+        Take the lease on fetching a query, unless another owner holds it.
+
+        A lease that has expired, e.g. because its process died, is taken
+        over. Since SQLite serializes writers, at most one owner gets it.
+
+        Parameters
+        ----------
+        query : str
+            The query to fetch.
+        owner : str
+            A token that identifies the caller.
+        ttl : float
+            Seconds after which the lease expires.
+        page : int
+            The page of results to fetch.
+
+        Returns
+        -------
+        bool
+            Whether the caller holds the lease now.
+        """
+        now = time.time()
+        with self.con:
+            cur = self.con.execute(
+                """
+                INSERT INTO flights (query, page, owner, expires) VALUES(?, ?, ?, ?)
+                ON CONFLICT(query, page) DO UPDATE SET
+                    owner=excluded.owner,
+                    expires=excluded.expires
+                WHERE flights.expires < ?
+                """,
+                [canonical_query(query), page, owner, now + ttl, now],
+            )
+        return cur.rowcount == 1
+
+    def release_lease(self, query, owner, page=1):
+        """
+        Give up the lease on fetching a page of a query, if the caller holds it.
+
+        Returns
+        -------
+        None
+        """
+        with self.con:
+            self.con.execute(
+                "DELETE FROM flights WHERE query=? AND page=? AND owner=?",
+                [canonical_query(query), page, owner],
+            )
+
+    def update_relevance(self, query, link, relevance):
+        """
+        Update the relevance of a search result in the database.
+
+        A positive relevance also counts as a click in the feedback table,
+        but only for a link that is a stored result of the query, so a
+        client cannot promote arbitrary links or domains.
+
+        Parameters
+        ----------
+        query : str
+            The query the result is for.
+        link : str
+            The link of the result.
+        relevance : int
+            The new relevance value.
+
+        Returns
+        -------
+        None
+        """
+        cur = self.con.cursor()
+        cur.execute(
+            "UPDATE results SET relevance=? WHERE query_key=? AND link=?",
+            [relevance, canonical_query(query), link],
+        )
+        if cur.rowcount > 0:
+            cur.execute(
+                "UPDATE queries SET generation=generation + 1 WHERE query=?",
+                [canonical_query(query)],
+            )
+            if relevance > 0:
+                self.record_feedback(link)
+        self.con.commit()
+        cur.close()
+        notify([canonical_query(query)])
+
+    def record_feedback(self, link, weight=1.0, at=None):
+        """
+        Add one relevance click for a link, and for its domain.
+
+        Scores decay by half every FEEDBACK_HALF_LIFE seconds. Each row
+        keeps its score as of the time it was last updated, and the upsert
+        decays the stored score and the new click to the later of the two
+        times before adding them, so the stored values never exceed the
+        number of clicks. feedback_scores decays them to the current time.
+        The table holds one row per link and per domain, however many
+        clicks there are. The caller is responsible for committing.
+
+        Parameters
+        ----------
+        link : str
+            The link that was marked relevant.
+        weight : float
+            The weight of the click.
+        at : float
+            The time of the click as a Unix timestamp. Defaults to now.
+
+        Returns
+        -------
+        None
+        """
+        at = time.time() if at is None else at
+        rows = [("link", link, weight, at)]
+        domain = link_domain(link)
+        if domain:
+            rows.append(("domain", domain, weight, at))
+        self.con.executemany(
+            """
+            INSERT INTO feedback (kind, key, score, updated) VALUES(?, ?, ?, ?)
+            ON CONFLICT(kind, key) DO UPDATE SET
+                score=score * feedback_decay(excluded.updated - updated)
+                    + excluded.score * feedback_decay(updated - excluded.updated),
+                updated=max(updated, excluded.updated)
+            """,
+            rows,
+        )
+
+    def feedback_scores(self, links):
+        """
+        Return the current feedback score of each link.
+
+        The score of a link is its own decayed click count plus
+        FEEDBACK_DOMAIN_WEIGHT times that of its domain.
+
+        Parameters
+        ----------
+        links : iterable
+            The links to score.
+
+        Returns
+        -------
+        scores : pandas Series
+            The score of each distinct link, indexed by link. Links
+            without feedback score 0.
+        """
+        links = list(dict.fromkeys(links))
+        domains = [link_domain(link) for link in links]
+        keys = [("link", link) for link in links] + [
+            ("domain", domain) for domain in dict.fromkeys(domains) if domain
+        ]
+        stored = {}
+        now = time.time()
+        for i in range(0, len(keys), 400):
+            chunk = keys[i : i + 400]
+            marks = " OR ".join(["(kind=? AND key=?)"] * len(chunk))
+            params = [value for key in chunk for value in key]
+            for kind, key, score, updated in self.con.execute(
+                f"SELECT kind, key, score, updated FROM feedback WHERE {marks}", params
+            ):
+                stored[(kind, key)] = score * feedback_decay(now - updated)
+        return pd.Series(
+            [
+                stored.get(("link", link), 0.0)
+                + FEEDBACK_DOMAIN_WEIGHT * stored.get(("domain", domain), 0.0)
+                for link, domain in zip(links, domains)
+            ],
+            index=links,
+            dtype=float,
         )
-        self.con.commit()
-        cur.close()